@@ -5,6 +5,9 @@ __license__ = 'https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode'
 __revision__ = '20171206'
 
 import configparser, flask, getopt, json, logging, os, random, sys
+# Device tables are read as the discovery scripts save them
+sys.path.append('{}/scripts'.format(os.path.dirname(os.path.abspath(__file__))))
+from functions import iterDeviceInfo
 
 # Default settings
 logging.basicConfig(level = logging.WARNING)
@@ -16,11 +19,26 @@ links = []
 devices_file = '{}/devices.ini'.format(working_dir)
 device_options = configparser.ConfigParser()
 device_options.read(devices_file)
+# Device tables served one entry per line, saved as NDJSON or JSON by the discovery scripts
+device_tables = ['arp_table', 'mac_address_table']
 
 def usage():
     print('Usage: {} [OPTIONS]'.format(sys.argv[0]))
     print('  -d         enable debug')
 
+def mergeNeighbors(cdp_neighbors, lldp_neighbors):
+    # LLDP neighbors already seen by CDP on the same interface are skipped (port names differ between the two)
+    neighbors = {}
+    for device_if_name, cdp_interface_neighbors in cdp_neighbors.items():
+        neighbors[device_if_name] = list(cdp_interface_neighbors)
+    for device_if_name, lldp_interface_neighbors in lldp_neighbors.items():
+        cdp_names = [neighbor['remote_system_name'].lower().split('.')[0] for neighbor in neighbors.get(device_if_name, [])]
+        for neighbor in lldp_interface_neighbors:
+            if neighbor['remote_system_name'].lower().split('.')[0] not in cdp_names:
+                neighbors.setdefault(device_if_name, [])
+                neighbors[device_if_name].append(neighbor)
+    return neighbors
+
 def saveConfig():
     with open(devices_file, 'w') as device_fp:
         device_options.write(device_fp)
@@ -113,6 +131,16 @@ def getConnections():
     }
     return flask.jsonify(response), response['code']
 
+# curl -s -D- -X GET http://127.0.0.1:5000/api/devices/deviceid/mac_address_table
+@app.route('/api/devices/<id>/<table>', methods = ['GET'])
+def getDeviceTable(id, table):
+    device_dir = '{}/devices/{}'.format(working_dir, id)
+    if table not in device_tables or id.startswith('.') or not os.path.isdir(device_dir):
+        flask.abort(404)
+    # Streamed as NDJSON, one entry per line
+    entries = iterDeviceInfo(device_dir, table)
+    return flask.Response((json.dumps(entry) + '\n' for entry in entries), mimetype = 'application/x-ndjson')
+
 def main():
     # Set default
     discovered_devices = {}
@@ -155,10 +183,19 @@ def main():
                 logging.warning('cannot read CDP neighbors for device ({})'.format(dirname))
                 cdp_neighbors = {}
 
+            # Reading LLDP neighbors
+            try:
+                lldp_neighbors = json.load(open('{}/lldp_neighbors.json'.format(device_dir)))
+            except FileNotFoundError:
+                lldp_neighbors = {}
+            except:
+                logging.warning('cannot read LLDP neighbors for device ({})'.format(dirname))
+                lldp_neighbors = {}
+
             # Saving data
             discovered_devices.setdefault(fqdn, {})
             discovered_devices[fqdn] = {
-                'neighbors': cdp_neighbors
+                'neighbors': mergeNeighbors(cdp_neighbors, lldp_neighbors)
             }
 
     # For each device
@@ -235,5 +272,5 @@ def main():
 
 if __name__ == "__main__":
     main()
-    app.run(host = '0.0.0.0', port = 5000, extra_files = [devices_file, 'devices/*/cdp_neighbors.json', 'templates/template.html'], debug = True)
+    app.run(host = '0.0.0.0', port = 5000, extra_files = [devices_file, 'devices/*/cdp_neighbors.json', 'devices/*/lldp_neighbors.json', 'templates/template.html'], debug = True)
     sys.exit(0)
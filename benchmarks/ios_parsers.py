@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+__author__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__license__ = 'https://www.gnu.org/licenses/gpl.html'
+__revision__ = '20170329'
+
+import getopt, importlib.util, logging, os, sys, time
+
+logging.basicConfig(level = logging.WARNING)
+logger = logging.getLogger(__name__)
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+driver_file = '{}/../old/napalm_ios.py'.format(benchmark_dir)
+
+def usage():
+    print('Usage: {} [OPTIONS]'.format(sys.argv[0]))
+    print('  -n INT     number of synthetic entries per MAC address table (default: 100000)')
+    print('  -i INT     number of synthetic interfaces (default: 1000)')
+    print('  -r INT     parse each table INT times, the best time is reported (default: 3)')
+    print('  -b STRING  baseline napalm_ios.py of any revision to compare with, e.g. from git show REV:old/napalm_ios.py')
+    print('  -d         enable debug')
+    sys.exit(1)
+
+def loadDriver(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def synthetic6500(entries):
+    lines = [
+        'Legend: * - primary entry',
+        '        age - seconds since last seen',
+        '        n/a - not available',
+        '',
+        '  vlan   mac address     type    learn     age              ports',
+        '------+----------------+--------+-----+----------+--------------------------'
+    ]
+    for i in range(entries):
+        mac = '{:04x}.{:04x}.{:04x}'.format(0x0050, i >> 16, i & 0xffff)
+        if i % 100 == 99:
+            # Flooded to many ports, continued on the next line at column 51
+            lines.append('*{:>5}  {}   {:<7}  {:<3}  {:>9}   {}'.format(i % 4000 + 1, mac, 'static', 'No', '-', ','.join('Gi1/{}'.format(port) for port in range(1, 9))))
+            lines.append('{}{}'.format(' ' * 51, ','.join('Gi2/{}'.format(port) for port in range(1, 5))))
+        else:
+            lines.append('{}{:>5}  {}   {:<7}  {:<3}  {:>9}   {}'.format('*' if i % 2 else ' ', i % 4000 + 1, mac, 'dynamic', 'Yes', i % 300, 'Gi{}/{}'.format(i % 9 + 1, i % 48 + 1) if i % 5 else 'Po{}'.format(i % 16 + 1)))
+    return '\n'.join(lines)
+
+def synthetic4500(entries):
+    lines = [
+        'Unicast Entries',
+        ' vlan   mac address     type        protocols               port',
+        '-------+---------------+--------+---------------------+--------------------'
+    ]
+    multicast = entries // 100
+    for i in range(entries - multicast):
+        mac = '{:04x}.{:04x}.{:04x}'.format(0x0019, i >> 16, i & 0xffff)
+        lines.append(' {:<6} {}   {:<7} {:<21} {}'.format(i % 4000 + 1, mac, 'dynamic', 'ip,ipx,assigned,other', 'GigabitEthernet{}/{}'.format(i % 6 + 1, i % 48 + 1)))
+    lines.extend([
+        '',
+        'Multicast Entries',
+        ' vlan    mac address     type    ports',
+        '-------+---------------+-------+--------------------------------------------'
+    ])
+    for i in range(multicast):
+        # Continued on the next line at column 32
+        mac = '{:04x}.{:04x}.{:04x}'.format(0x0100, 0x5e00, i & 0xffff)
+        lines.append(' {:<6} {}  {:<7} {}'.format(i % 4000 + 1, mac, 'system', ','.join('Gi1/{}'.format(port) for port in range(1, 7))))
+        lines.append('{}{}'.format(' ' * 32, ','.join('Gi2/{}'.format(port) for port in range(1, 7))))
+    return '\n'.join(lines)
+
+def synthetic2960(entries):
+    lines = [
+        '          Mac Address Table',
+        '-------------------------------------------',
+        '',
+        'Vlan    Mac Address       Type        Ports',
+        '----    -----------       --------    -----',
+        ' All    0100.0ccc.cccc    STATIC      CPU',
+        ' All    0180.c200.0000    STATIC      CPU'
+    ]
+    for i in range(entries - 2):
+        mac = '{:04x}.{:04x}.{:04x}'.format(0x001b, i >> 16, i & 0xffff)
+        lines.append('{:>4}    {}    {:<8}    {}'.format(i % 1000 + 1, mac, 'DYNAMIC', 'Fa0/{}'.format(i % 48 + 1) if i % 10 else 'Gi0/{}'.format(i % 2 + 1)))
+    lines.append('Total Mac Addresses for this criterion: {}'.format(entries))
+    return '\n'.join(lines)
+
+def syntheticInterfaces(interfaces):
+    # Line cards of 48 ports, up, down or shut down, half of them with a description
+    blocks = []
+    summary = [
+        ' *: interface is up',
+        ' IHQ: pkts in input hold queue     IQD: pkts dropped from input queue',
+        ' OHQ: pkts in output hold queue    OQD: pkts dropped from output queue',
+        '',
+        '  Interface                   IHQ       IQD       OHQ       OQD      RXBS      RXPS      TXBS      TXPS      TRTL',
+        '-----------------------------------------------------------------------------------------------------------------'
+    ]
+    for i in range(interfaces):
+        name = 'GigabitEthernet{}/{}'.format(i // 48 + 1, i % 48 + 1)
+        if i % 10 == 9:
+            status, protocol = 'administratively down', 'down (disabled)'
+        elif i % 3:
+            status, protocol = 'up', 'up (connected)'
+        else:
+            status, protocol = 'down', 'down (notconnect)'
+        blocks.append('{} is {}, line protocol is {}'.format(name, status, protocol))
+        blocks.append('  Hardware is Gigabit Ethernet Port, address is 0022.90{:02x}.{:04x} (bia 0022.90{:02x}.{:04x})'.format(i >> 16, i & 0xffff, i >> 16, i & 0xffff))
+        if i % 2:
+            blocks.append('  Description: server {} uplink'.format(i))
+        blocks.extend([
+            '  MTU 1500 bytes, BW {} Kbit/sec, DLY 10 usec, '.format(1000000 if i % 3 else 10000000),
+            '     reliability 255/255, txload 1/255, rxload 1/255',
+            '  Encapsulation ARPA, loopback not set',
+            '  Keepalive set (10 sec)',
+            '  Full-duplex, 1000Mb/s, media type is 10/100/1000BaseTX',
+            '  input flow-control is off, output flow-control is unsupported',
+            '  ARP type: ARPA, ARP Timeout 04:00:00',
+            '  Last input 00:00:01, output 00:00:00, output hang never',
+            '  Last clearing of "show interface" counters never',
+            '  Input queue: 0/2000/0/0 (size/max/drops/flushes); Total output drops: {}'.format(i % 7),
+            '  Queueing strategy: fifo',
+            '  Output queue: 0/40 (size/max)',
+            '  5 minute input rate {} bits/sec, {} packets/sec'.format(i * 1000, i),
+            '  5 minute output rate {} bits/sec, {} packets/sec'.format(i * 2000, i * 2),
+            '     {} packets input, {} bytes, 0 no buffer'.format(i * 123457, i * 98765431),
+            '     Received {} broadcasts ({} multicasts)'.format(i * 1234, i * 7),
+            '     0 runts, 0 giants, 0 throttles',
+            '     {} input errors, {} CRC, 0 frame, 0 overrun, 0 ignored'.format(i % 5, i % 5),
+            '     0 watchdog, {} multicast, 0 pause input'.format(i * 7),
+            '     0 input packets with dribble condition detected',
+            '     {} packets output, {} bytes, 0 underruns'.format(i * 234567, i * 87654321),
+            '     {} output errors, 0 collisions, 1 interface resets'.format(i % 3),
+            '     0 unknown protocol drops',
+            '     0 babbles, 0 late collision, 0 deferred',
+            '     0 lost carrier, 0 no carrier, 0 PAUSE output',
+            '     0 output buffer failures, 0 output buffers swapped out'
+        ])
+        summary.append('{} {:<26}{:>5}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('*' if i % 3 else ' ', name, 0, i % 11, 0, i % 7, i * 1000, i, i * 2000, i * 2, 0))
+    return {
+        'show interfaces': '\n'.join(blocks),
+        'show interface summary': '\n'.join(summary)
+    }
+
+# Benchmarked getter, size option and synthetic outputs {command: output}
+benchmarks = [
+    ('get_mac_address_table', 'entries', [
+        ('6500', lambda entries: {'show mac-address-table': synthetic6500(entries)}),
+        ('4500', lambda entries: {'show mac-address-table': synthetic4500(entries)}),
+        ('2960', lambda entries: {'show mac-address-table': synthetic2960(entries)})
+    ]),
+    ('get_interfaces', 'interfaces', [
+        ('chassis', syntheticInterfaces)
+    ]),
+    ('get_interfaces_counters', 'interfaces', [
+        ('chassis', syntheticInterfaces)
+    ])
+]
+
+def newDevice(module, outputs):
+    # The getters of any IOSDriver read the synthetic outputs instead of a device, the original
+    # napalm_ios.py (without IOSOutputDriver) included
+    class BenchmarkDriver(module.IOSDriver):
+        def _send_command(self, command):
+            for cmd in command if isinstance(command, list) else [command]:
+                if cmd in outputs:
+                    return self._send_command_postprocess(outputs[cmd])
+            raise ValueError('no synthetic output for "{}"'.format(command))
+    return BenchmarkDriver('benchmark', '', '')
+
+def timeGetter(module, getter, outputs, repeat):
+    device = newDevice(module, outputs)
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = getattr(device, getter)()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def compareResults(result, baseline_result):
+    # Per-interface getters: which fields differ from the baseline
+    if result == baseline_result:
+        return 'same result'
+    if isinstance(result, dict) and isinstance(baseline_result, dict) and set(result) == set(baseline_result):
+        fields = set()
+        for key, value in result.items():
+            baseline_value = baseline_result[key]
+            if isinstance(value, dict) and isinstance(baseline_value, dict):
+                fields.update(field for field in set(value) | set(baseline_value) if value.get(field) != baseline_value.get(field))
+        if fields:
+            return 'different {}'.format(', '.join(sorted(fields)))
+    return 'DIFFERENT RESULT'
+
+def main():
+    sizes = {'entries': 100000, 'interfaces': 1000}
+    repeat = 3
+    baseline_file = None
+
+    # Reading options
+    try:
+        opts, other_args = getopt.getopt(sys.argv[1:], 'b:di:n:r:')
+    except getopt.GetoptError as err:
+        logger.error('cannot parse options', exc_info = True)
+        usage()
+    try:
+        for opt, arg in opts:
+            if opt == '-d':
+                logger.setLevel(logging.DEBUG)
+            elif opt == '-n':
+                sizes['entries'] = int(arg)
+            elif opt == '-i':
+                sizes['interfaces'] = int(arg)
+            elif opt == '-r':
+                repeat = int(arg)
+            elif opt == '-b':
+                baseline_file = arg
+    except ValueError as err:
+        logger.error('invalid option value', exc_info = True)
+        usage()
+
+    driver = loadDriver(driver_file, 'napalm_ios')
+    baseline = loadDriver(baseline_file, 'napalm_ios_baseline') if baseline_file else None
+    for getter, size, tables in benchmarks:
+        for name, synthetic in tables:
+            outputs = synthetic(sizes[size])
+            elapsed, result = timeGetter(driver, getter, outputs, repeat)
+            print('{} {}: {} entries in {:.3f}s, {:.0f} entries/sec'.format(getter, name, len(result), elapsed, len(result) / elapsed if elapsed else 0))
+            if baseline:
+                # Classes from different files: results are compared as plain data
+                baseline_elapsed, baseline_result = timeGetter(baseline, getter, outputs, repeat)
+                print('{} {}: baseline {:.3f}s, {:.1f}x faster, {}'.format(getter, name, baseline_elapsed, baseline_elapsed / elapsed if elapsed else 0, compareResults(result, baseline_result)))
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+__author__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__license__ = 'https://www.gnu.org/licenses/gpl.html'
+__revision__ = '20170329'
+
+import asyncio, getopt, json, logging, os, shutil, sys, tempfile, time
+from snmp_simulator import *
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+discovery_script = '{}/../scripts/discovery_with_snmp.py'.format(benchmark_dir)
+
+def usage():
+    print('Usage: {} [OPTIONS]'.format(sys.argv[0]))
+    print('  -s STRING  snapshot directory (default: snapshots)')
+    print('  -n INT     number of simulated devices (default: 100)')
+    print('  -l FLOAT   response latency in milliseconds (default: 10)')
+    print('  -L FLOAT   packet loss between 0 and 1 (default: 0)')
+    print('  -P INT     UDP port of the simulated agents (default: {})'.format(default_port))
+    print('  -c INT     number of hosts discovered concurrently (default: 10)')
+    print('  -p INT     number of concurrent requests per host (default: 1)')
+    print('  -w INT     number of discovery worker processes (default: 1)')
+    print('  -k         keep the working directory')
+    print('  -d         enable debug')
+    sys.exit(1)
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+def writeInventory(path, agents, port):
+    output = open(path, 'w+')
+    output.write('[simulated]\n')
+    for agent in agents:
+        output.write('{} ansible_host={} snmp_version=2c snmp_community=public snmp_port={}\n'.format(agent.address.replace('.', '_'), agent.address, port))
+    output.close()
+
+async def runBenchmark(snapshot_dir, devices, latency, loss, port, args, working_dir):
+    agents = await startAgents(loadSnapshots(snapshot_dir), devices, port, latency, loss)
+    inventory_file = '{}/hosts'.format(working_dir)
+    writeInventory(inventory_file, agents, port)
+    try:
+        started = time.time()
+        cpu_started = time.process_time()
+        process = await asyncio.create_subprocess_exec(sys.executable, discovery_script, '-i', inventory_file, *args, env = dict(os.environ, NETDOC_FOLDER = 'benchmark'))
+        await process.wait()
+        elapsed = time.time() - started
+        cpu = time.process_time() - cpu_started
+    finally:
+        stopAgents(agents)
+    if process.returncode:
+        logger.error('discovery exited with code {}'.format(process.returncode))
+    return elapsed, cpu, sum(agent.pdus for agent in agents)
+
+def main():
+    snapshot_dir = '{}/snapshots'.format(benchmark_dir)
+    devices = 100
+    latency = 0.01
+    loss = 0.0
+    port = default_port
+    keep = False
+    args = ['-c', '10']
+
+    # Reading options
+    try:
+        opts, other_args = getopt.getopt(sys.argv[1:], 'c:dkl:L:n:p:P:s:w:')
+    except getopt.GetoptError as err:
+        logger.error('cannot parse options', exc_info = True)
+        usage()
+    try:
+        for opt, arg in opts:
+            if opt == '-d':
+                logger.setLevel(logging.DEBUG)
+                args.append('-d')
+            elif opt == '-s':
+                snapshot_dir = arg
+            elif opt == '-n':
+                devices = int(arg)
+            elif opt == '-l':
+                latency = float(arg) / 1000
+            elif opt == '-L':
+                loss = float(arg)
+            elif opt == '-P':
+                port = int(arg)
+            elif opt == '-c':
+                args[1] = str(int(arg))
+            elif opt == '-p':
+                args.extend(['-p', str(int(arg))])
+            elif opt == '-w':
+                args.extend(['--workers', str(int(arg))])
+            elif opt == '-k':
+                keep = True
+    except ValueError as err:
+        logger.error('invalid option value', exc_info = True)
+        usage()
+
+    working_dir = tempfile.mkdtemp(prefix = 'netdoc-benchmark-')
+    try:
+        elapsed, cpu, pdus = asyncio.run(runBenchmark(snapshot_dir, devices, latency, loss, port, args, working_dir))
+        summary_file = '{}/working/benchmark/discovery_summary.json'.format(working_dir)
+        try:
+            summary = json.load(open(summary_file))
+        except Exception as err:
+            logger.error('cannot read "{}"'.format(summary_file), exc_info = True)
+            sys.exit(1)
+    finally:
+        if keep:
+            print('working directory: {}'.format(working_dir))
+        else:
+            shutil.rmtree(working_dir, ignore_errors = True)
+
+    # Per-host latency comes from the run summary written by the discovery script
+    latencies = [result['elapsed'] for result in summary['hosts'].values() if result['status'] == 'discovered']
+    print('devices:          {} discovered, {} failed, {} simulated'.format(summary['summary']['discovered'], summary['summary']['failed'], devices))
+    print('elapsed:          {:.3f}s discovery, {:.3f}s including process startup'.format(summary['summary']['elapsed'], elapsed))
+    print('devices/sec:      {:.2f}'.format(summary['summary']['discovered'] / summary['summary']['elapsed'] if summary['summary']['elapsed'] else 0))
+    # All agents share one process: when it is near 100% the simulator is the bottleneck
+    print('simulator CPU:    {:.3f}s ({:.0f}% of elapsed)'.format(cpu, 100 * cpu / elapsed if elapsed else 0))
+    print('PDUs/device:      {:.1f}'.format(pdus / devices))
+    print('host latency p50: {:.3f}s'.format(percentile(latencies, 50)))
+    print('host latency p99: {:.3f}s'.format(percentile(latencies, 99)))
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+__author__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__license__ = 'https://www.gnu.org/licenses/gpl.html'
+__revision__ = '20170329'
+
+import asyncio, bisect, getopt, glob, logging, os, random, sys
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api, rfc1902, rfc1905
+
+logging.basicConfig(level = logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Snapshots use the snmprec format (OID|TAG|VALUE), as recorded by snmprec.py from snmpsim
+snmprec_tags = {
+    '2': rfc1902.Integer32,
+    '4': rfc1902.OctetString,
+    '6': rfc1902.ObjectIdentifier,
+    '64': rfc1902.IpAddress,
+    '65': rfc1902.Counter32,
+    '66': rfc1902.Gauge32,
+    '67': rfc1902.TimeTicks,
+    '70': rfc1902.Counter64
+}
+sysName = (1, 3, 6, 1, 2, 1, 1, 5, 0)
+default_port = 16161
+
+def usage():
+    print('Usage: {} [OPTIONS]'.format(sys.argv[0]))
+    print('  -s STRING  snapshot directory (default: snapshots)')
+    print('  -n INT     number of simulated devices (default: 10)')
+    print('  -l FLOAT   response latency in milliseconds (default: 0)')
+    print('  -L FLOAT   packet loss between 0 and 1 (default: 0)')
+    print('  -P INT     UDP port (default: {})'.format(default_port))
+    print('  -d         enable debug')
+    sys.exit(1)
+
+def loadSnapshot(path):
+    table = []
+    for line in open(path):
+        line = line.rstrip('\n')
+        if not line or line.startswith('#'):
+            continue
+        oid, tag, value = line.split('|', 2)
+        if tag.endswith('x'):
+            value = snmprec_tags[tag[:-1]](hexValue = value)
+        elif tag in ['2', '65', '66', '67', '70']:
+            value = snmprec_tags[tag](int(value))
+        else:
+            value = snmprec_tags[tag](value)
+        table.append((tuple(int(i) for i in oid.strip('.').split('.')), value))
+    table.sort(key = lambda row: row[0])
+    return table
+
+def loadSnapshots(path):
+    # NAME@CONTEXT.snmprec files are answered to community@CONTEXT (e.g. Cisco per-VLAN BRIDGE-MIB)
+    snapshots = []
+    for snapshot_file in sorted(glob.glob('{}/*.snmprec'.format(path))):
+        if '@' in os.path.basename(snapshot_file):
+            continue
+        contexts = {}
+        for context_file in sorted(glob.glob('{}@*.snmprec'.format(snapshot_file[:-len('.snmprec')]))):
+            contexts[os.path.basename(context_file)[:-len('.snmprec')].split('@', 1)[1]] = loadSnapshot(context_file)
+        snapshots.append((loadSnapshot(snapshot_file), contexts))
+    if not snapshots:
+        raise FileNotFoundError('no .snmprec file found in "{}"'.format(path))
+    return snapshots
+
+class SimulatedAgent(asyncio.DatagramProtocol):
+    # SNMPv1/v2c agent answering GET, GETNEXT and GETBULK from a snapshot
+    def __init__(self, table, community = 'public', latency = 0.0, loss = 0.0, max_size = 65507, contexts = None):
+        self.table = table
+        self.oids = [row[0] for row in table]
+        self.community = community
+        self.contexts = {'{}@{}'.format(community, context): (context_table, [row[0] for row in context_table]) for context, context_table in (contexts or {}).items()}
+        self.latency = latency
+        self.loss = loss
+        self.max_size = max_size
+        self.pdus = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def getNext(self, oid, table, oids):
+        i = bisect.bisect_right(oids, oid)
+        if i < len(table):
+            return table[i]
+        return oid, rfc1905.endOfMibView
+
+    def getExact(self, oid, table, oids):
+        i = bisect.bisect_left(oids, oid)
+        if i < len(oids) and oids[i] == oid:
+            return oid, table[i][1]
+        return oid, rfc1905.noSuchObject
+
+    def datagram_received(self, data, address):
+        self.pdus += 1
+        if self.loss and random.random() < self.loss:
+            return
+        try:
+            response = self.getResponse(data)
+        except Exception as err:
+            logger.debug('cannot decode request from "{}"'.format(address), exc_info = True)
+            return
+        if not response:
+            return
+        if self.latency:
+            asyncio.get_event_loop().call_later(self.latency, self.transport.sendto, response, address)
+        else:
+            self.transport.sendto(response, address)
+
+    def getResponse(self, data):
+        version = api.decodeMessageVersion(data)
+        proto = api.protoModules[version]
+        request, rest = decoder.decode(data, asn1Spec = proto.Message())
+        community = str(proto.apiMessage.getCommunity(request))
+        if community == self.community:
+            table, oids = self.table, self.oids
+        elif community in self.contexts:
+            table, oids = self.contexts[community]
+        else:
+            # Wrong community or unknown context, as a real agent does
+            return None
+        response = proto.apiMessage.getResponse(request)
+        request_pdu = proto.apiMessage.getPDU(request)
+        response_pdu = proto.apiMessage.getPDU(response)
+        var_binds = [(tuple(oid), value) for oid, value in proto.apiPDU.getVarBinds(request_pdu)]
+
+        if request_pdu.isSameTypeWith(proto.GetRequestPDU()):
+            output = [self.getExact(oid, table, oids) for oid, value in var_binds]
+        elif request_pdu.isSameTypeWith(proto.GetNextRequestPDU()):
+            output = [self.getNext(oid, table, oids) for oid, value in var_binds]
+        elif version == api.protoVersion2c and request_pdu.isSameTypeWith(proto.GetBulkRequestPDU()):
+            non_repeaters = int(proto.apiBulkPDU.getNonRepeaters(request_pdu))
+            max_repetitions = int(proto.apiBulkPDU.getMaxRepetitions(request_pdu))
+            output = [self.getNext(oid, table, oids) for oid, value in var_binds[:non_repeaters]]
+            columns = [oid for oid, value in var_binds[non_repeaters:]]
+            for repetition in range(max_repetitions):
+                row = [self.getNext(oid, table, oids) for oid in columns]
+                output.extend(row)
+                columns = [oid for oid, value in row]
+                if all(value is rfc1905.endOfMibView for oid, value in row):
+                    break
+        else:
+            return None
+
+        if version == api.protoVersion1:
+            # SNMPv1 has no exceptions in varbinds: noSuchName points to the first missing one
+            for i, (oid, value) in enumerate(output):
+                if value is rfc1905.endOfMibView or value is rfc1905.noSuchObject:
+                    output = var_binds
+                    proto.apiPDU.setErrorStatus(response_pdu, 2)
+                    proto.apiPDU.setErrorIndex(response_pdu, i + 1)
+                    break
+        proto.apiPDU.setVarBinds(response_pdu, output)
+        message = encoder.encode(response)
+        if len(message) > self.max_size:
+            # tooBig
+            proto.apiPDU.setVarBinds(response_pdu, var_binds)
+            proto.apiPDU.setErrorStatus(response_pdu, 1)
+            proto.apiPDU.setErrorIndex(response_pdu, 0)
+            message = encoder.encode(response)
+        return message
+
+def getDeviceAddress(i):
+    # Each device gets its own loopback address, the collector keys hosts by address
+    return '127.0.{}.{}'.format((i + 2) // 256, (i + 2) % 256)
+
+async def startAgents(snapshots, devices, port = default_port, latency = 0.0, loss = 0.0):
+    loop = asyncio.get_running_loop()
+    agents = []
+    for i in range(devices):
+        # Snapshots are used round-robin, each device gets an unique sysName
+        table, contexts = snapshots[i % len(snapshots)]
+        table = [(oid, rfc1902.OctetString('sim{}'.format(i + 1)) if oid == sysName else value) for oid, value in table]
+        agent = SimulatedAgent(table, latency = latency, loss = loss, contexts = contexts)
+        agent.address = getDeviceAddress(i)
+        await loop.create_datagram_endpoint(lambda agent = agent: agent, local_addr = (agent.address, port))
+        agents.append(agent)
+    return agents
+
+def stopAgents(agents):
+    for agent in agents:
+        if agent.transport:
+            agent.transport.close()
+
+def main():
+    snapshot_dir = '{}/snapshots'.format(os.path.dirname(os.path.abspath(__file__)))
+    devices = 10
+    latency = 0.0
+    loss = 0.0
+    port = default_port
+
+    # Reading options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'dl:L:n:P:s:')
+    except getopt.GetoptError as err:
+        logger.error('cannot parse options', exc_info = True)
+        usage()
+    try:
+        for opt, arg in opts:
+            if opt == '-d':
+                logger.setLevel(logging.DEBUG)
+            elif opt == '-s':
+                snapshot_dir = arg
+            elif opt == '-n':
+                devices = int(arg)
+            elif opt == '-l':
+                latency = float(arg) / 1000
+            elif opt == '-L':
+                loss = float(arg)
+            elif opt == '-P':
+                port = int(arg)
+    except ValueError as err:
+        logger.error('invalid option value', exc_info = True)
+        usage()
+
+    async def serve():
+        agents = await startAgents(loadSnapshots(snapshot_dir), devices, port, latency, loss)
+        logger.warning('serving {} devices on {}..{} port {}'.format(devices, agents[0].address, agents[-1].address, port))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            stopAgents(agents)
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
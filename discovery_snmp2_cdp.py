@@ -9,6 +9,9 @@ from ansible.parsing.dataloader import DataLoader
 from ansible.inventory.manager import InventoryManager
 from ansible.vars.manager import VariableManager
 from pysnmp.hlapi import *
+# SNMP engines are shared as in the discovery scripts
+sys.path.append('{}/scripts'.format(os.path.dirname(os.path.abspath(__file__))))
+from snmp_functions import SNMPEngines
 
 # Default settings
 logging.basicConfig(level = logging.WARNING)
@@ -25,16 +28,25 @@ def usage():
     print('  -i STRING  inventory file')
     print('  -d         enable debug')
 
-def getFacts(community, host):
-    errorIndication, errorStatus, errorIndex, varBinds = next(
-        getCmd(SnmpEngine(),
-            CommunityData(community),
-            UdpTransportTarget((host, 161)),
-            ContextData(),
-            ObjectType(ObjectIdentity(sysName)),
-            lookupMib = False
-        )
-    )
+class SNMPSession:
+    # One transport and authentication per host, engines are shared by credentials (see SNMPEngines)
+    engines = SNMPEngines(SnmpEngine)
+
+    def __init__(self, host, auth, port = 161):
+        self.host = host
+        self.auth = auth
+        self.engine = self.engines.get(auth)
+        self.transport = UdpTransportTarget((host, port))
+        self.context = ContextData()
+
+    def get(self, *oids):
+        return next(getCmd(self.engine, self.auth, self.transport, self.context, *[ObjectType(ObjectIdentity(oid)) for oid in oids], lookupMib = False))
+
+    def walk(self, *oids):
+        return nextCmd(self.engine, self.auth, self.transport, self.context, *[ObjectType(ObjectIdentity(oid)) for oid in oids], lookupMib = False, lexicographicMode = False)
+
+def getFacts(session):
+    errorIndication, errorStatus, errorIndex, varBinds = session.get(sysName)
     if errorIndication or errorStatus or errorIndex:
         return None
     facts = {
@@ -44,35 +56,17 @@ def getFacts(community, host):
     }
     return facts
 
-def getCDPNeighbors(community, host):
+def getCDPNeighbors(session):
     # TODO: add multiple neighbors under a single interface
     neighbors = {}
     local_port = {}
 
-    for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-        SnmpEngine(),
-        CommunityData(community),
-        UdpTransportTarget((host, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity(ifDescr)),
-        lookupMib = False,
-        lexicographicMode = False
-    ):
+    for (errorIndication, errorStatus, errorIndex, varBinds) in session.walk(ifDescr):
         if errorIndication or errorStatus or errorIndex:
             return None
         local_port[int(str(varBinds[0][0]).split('.')[-1])] = str(varBinds[0][1])
 
-    for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-        SnmpEngine(),
-        CommunityData(community),
-        UdpTransportTarget((host, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity(cdpCacheDeviceId)),
-        ObjectType(ObjectIdentity(cdpCacheDevicePort)),
-        ObjectType(ObjectIdentity(cdpCachePlatform)),
-        lookupMib = False,
-        lexicographicMode = False
-    ):
+    for (errorIndication, errorStatus, errorIndex, varBinds) in session.walk(cdpCacheDeviceId, cdpCacheDevicePort, cdpCachePlatform):
         if errorIndication or errorStatus or errorIndex:
             return None
         neighbor_id = int(str(varBinds[0][0]).split('.')[-2])
@@ -140,9 +134,10 @@ def main():
         except:
             logging.error('cannot create directory (devices/{})'.format(host))
 
-        facts = getFacts(community = host.vars['snmp_community'], host = host.vars['ansible_host'])
+        session = SNMPSession(host.vars['ansible_host'], CommunityData(host.vars['snmp_community']))
+        facts = getFacts(session)
         logging.debug('connecting to {} using community {}'.format(host.vars['ansible_host'], host.vars['snmp_community']))
-        cdp_neighbors = getCDPNeighbors(community = host.vars['snmp_community'], host = host.vars['ansible_host'])
+        cdp_neighbors = getCDPNeighbors(session)
 
         try:
             facts_output = open('devices/{}/facts.json'.format(host), 'w+')
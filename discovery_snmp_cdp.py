@@ -9,6 +9,9 @@ from ansible.parsing.dataloader import DataLoader
 from ansible.inventory.manager import InventoryManager
 from ansible.vars.manager import VariableManager
 from pysnmp.hlapi import *
+# SNMP engines are shared as in the discovery scripts
+sys.path.append('{}/scripts'.format(os.path.dirname(os.path.abspath(__file__))))
+from snmp_functions import SNMPEngines
 
 # Default settings
 logging.basicConfig(level = logging.WARNING)
@@ -27,16 +30,25 @@ def usage():
     print('  -p STRING  SNMPv3 password (AuthNoPriv, SHA)')
     print('  -h STRING  device host or IP address (allowed multiple times)')
 
-def getFacts(username, password, host):
-    errorIndication, errorStatus, errorIndex, varBinds = next(
-        getCmd(SnmpEngine(),
-            UsmUserData(username, password, authProtocol = usmHMACSHAAuthProtocol),
-            UdpTransportTarget((host, 161)),
-            ContextData(),
-            ObjectType(ObjectIdentity(sysName)),
-            lookupMib = False
-        )
-    )
+class SNMPSession:
+    # One transport and authentication per host, engines are shared by credentials (see SNMPEngines)
+    engines = SNMPEngines(SnmpEngine)
+
+    def __init__(self, host, auth, port = 161):
+        self.host = host
+        self.auth = auth
+        self.engine = self.engines.get(auth)
+        self.transport = UdpTransportTarget((host, port))
+        self.context = ContextData()
+
+    def get(self, *oids):
+        return next(getCmd(self.engine, self.auth, self.transport, self.context, *[ObjectType(ObjectIdentity(oid)) for oid in oids], lookupMib = False))
+
+    def walk(self, *oids):
+        return nextCmd(self.engine, self.auth, self.transport, self.context, *[ObjectType(ObjectIdentity(oid)) for oid in oids], lookupMib = False, lexicographicMode = False)
+
+def getFacts(session):
+    errorIndication, errorStatus, errorIndex, varBinds = session.get(sysName)
     if errorIndication or errorStatus or errorIndex:
         return None
     facts = {
@@ -46,35 +58,17 @@ def getFacts(username, password, host):
     }
     return facts
 
-def getCDPNeighbors(username, password, host):
+def getCDPNeighbors(session):
     # TODO: add multiple neighbors under a single interface
     neighbors = {}
     local_port = {}
 
-    for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-        SnmpEngine(),
-        UsmUserData(username, password, authProtocol = usmHMACSHAAuthProtocol),
-        UdpTransportTarget((host, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity(ifDescr)),
-        lookupMib = False,
-        lexicographicMode = False
-    ):
+    for (errorIndication, errorStatus, errorIndex, varBinds) in session.walk(ifDescr):
         if errorIndication or errorStatus or errorIndex:
             return None
         local_port[int(str(varBinds[0][0]).split('.')[-1])] = str(varBinds[0][1])
 
-    for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-        SnmpEngine(),
-        UsmUserData(username, password, authProtocol = usmHMACSHAAuthProtocol),
-        UdpTransportTarget((host, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity(cdpCacheDeviceId)),
-        ObjectType(ObjectIdentity(cdpCacheDevicePort)),
-        ObjectType(ObjectIdentity(cdpCachePlatform)),
-        lookupMib = False,
-        lexicographicMode = False
-    ):
+    for (errorIndication, errorStatus, errorIndex, varBinds) in session.walk(cdpCacheDeviceId, cdpCacheDevicePort, cdpCachePlatform):
         if errorIndication or errorStatus or errorIndex:
             return None
         neighbor_id = int(str(varBinds[0][0]).split('.')[-2])
@@ -148,8 +142,9 @@ def main():
         except:
             logging.error('cannot create directory (devices/{})'.format(host))
 
-        facts = getFacts(username = host.vars['snmp_username'], password = host.vars['snmp_password'], host = host.vars['ansible_host'])
-        cdp_neighbors = getCDPNeighbors(username = host.vars['snmp_username'], password = host.vars['snmp_password'], host = host.vars['ansible_host'])
+        session = SNMPSession(host.vars['ansible_host'], UsmUserData(host.vars['snmp_username'], host.vars['snmp_password'], authProtocol = usmHMACSHAAuthProtocol))
+        facts = getFacts(session)
+        cdp_neighbors = getCDPNeighbors(session)
 
         try:
             facts_output = open('devices/{}/facts.json'.format(host), 'w+')
@@ -57,6 +57,40 @@ RE_IPADDR = re.compile(r"{}".format(IP_ADDR_REGEX))
 RE_IPADDR_STRIP = re.compile(r"({})\n".format(IP_ADDR_REGEX))
 RE_MAC = re.compile(r"{}".format(MAC_REGEX))
 
+# show interfaces: a block per interface, starting with an unindented header line
+RE_INTERFACE_HEADER = re.compile(r"^(\S+?)\s+is\s+(.+?),\s+line\s+protocol\s+is\s+(\S+)")
+RE_INTERFACE_HEADER_NO_PROTOCOL = re.compile(r"^(\S+)\s+is\s+(up|down)")
+RE_INTERFACE_MAC = re.compile(r"^\s+Hardware.+address\s+is\s+({})".format(MAC_REGEX))
+RE_INTERFACE_DESCRIPTION = re.compile(r"^\s+Description:\s+(.+?)$")
+RE_INTERFACE_SPEED = re.compile(r"^\s+MTU\s+\d+.+BW\s+(\d+)\s+([KMG]?b)")
+RE_INTERFACE_INPUT = re.compile(r"(\d+) packets input.* (\d+) bytes")
+RE_INTERFACE_BROADCASTS = re.compile(r"Received (\d+) broadcasts(?: \((\d+) (?:IP )?multicasts\))?")
+RE_INTERFACE_OUTPUT = re.compile(r"(\d+) packets output.* (\d+) bytes")
+RE_INTERFACE_INPUT_ERRORS = re.compile(r"(\d+) input errors")
+RE_INTERFACE_OUTPUT_ERRORS = re.compile(r"(\d+) output errors")
+# show interface summary: Interface  IHQ  IQD  OHQ  OQD  RXBS  RXPS  TXBS  TXPS  TRTL
+RE_INTERFACE_SUMMARY = re.compile(r"^\W*(\S+)\s+\d+\s+(\d+)\s+\d+\s+(\d+)\s+\d+\s+\d+\s+\d+\s+\d+\s+\d+")
+
+# show mac address-table: the header of each section gives the layout of its rows
+RE_MACTABLE_HEADER = re.compile(r"^\s*(?:vlan\s+mac\s+address|destination\s+address)", re.I)
+RE_MACTABLE_ROWS = {
+    # Destination Address  Address Type  VLAN  Destination Port
+    'default': re.compile(r"^\s*(?P<mac>{})\s+(?P<type>\S+)\s+(?P<vlan>\S+)\s+(?P<ports>\S+)\s*$".format(
+        MAC_REGEX)),
+    # Cat 6500: vlan  mac address  type  learn  age  ports
+    '6500': re.compile(r"^\s*\*?\s*(?P<vlan>{}|---)\s+(?P<mac>{})\s+(?P<type>\S+)\s+\S+\s+\S+\s+"
+                       r"(?P<ports>\S+)\s*$".format(VLAN_REGEX, MAC_REGEX)),
+    # Cat 4500 unicast: vlan  mac address  type  protocols  port
+    '4500': re.compile(r"^\s*(?P<vlan>{}|---)\s+(?P<mac>{})\s+(?P<type>\S+)\s+(?:\S+\s+)?"
+                       r"(?P<ports>\S+)\s*$".format(VLAN_REGEX, MAC_REGEX)),
+    # Cat 2960, Cat 4500 multicast: vlan  mac address  type  ports
+    '2960': re.compile(r"^\s*\*?\s*(?P<vlan>{}|All|---)\s+(?P<mac>{})\s+(?P<type>\S+)\s+"
+                       r"(?P<ports>\S+)\s*$".format(VLAN_REGEX, MAC_REGEX)),
+}
+# Ports of the row above, continued on an indented line
+RE_MACTABLE_CONTINUATION = re.compile(r"^\s+(?P<ports>\S+)\s*$")
+RE_MACTABLE_SKIP = re.compile(r"^\s*(?:-{2,}[-+\s]*$|Total Mac Addresses|Multicast Entries|Unicast Entries)", re.I)
+
 # Period needed for 32-bit AS Numbers
 ASN_REGEX = r"[\d\.]+"
 
@@ -64,6 +98,19 @@ IOS_COMMANDS = {
    'show_mac_address': ['show mac-address-table', 'show mac address-table'],
 }
 
+# Replay: outputs saved by the Ansible roles under their own name
+REPLAY_FILENAMES = {
+    'show running-config': ['running-config'],
+    'show tech-support': ['tech-support'],
+}
+# Replay: section headers of show tech-support, e.g. "------------------ show version ------------------"
+RE_TECH_SUPPORT_SECTION = re.compile(r"^-{10,} (show .+?) -{10,}[ \t]*\r?$", re.M)
+
+
+def command_filename(command):
+    """File name of a saved command output, e.g. show_ip_interface_brief (as the Ansible roles)."""
+    return re.sub(r"\W+", "_", command.strip()).strip("_")
+
 
 class IOSDriver(NetworkDriver):
     """NAPALM Cisco IOS Handler."""
@@ -790,19 +837,6 @@ class IOSDriver(NetworkDriver):
         return lldp
 
     def _get_lldp_neighbors(self, expand_name=True):
-
-        def _device_id_expand(device_id, local_int_brief):
-            """Device id might be abbreviated: try to obtain the full device id."""
-            # _lldp_detail_parser will execute a LLDP command on the device
-            lldp_tmp = self._lldp_detail_parser(local_int_brief)
-            device_id_new = lldp_tmp[3][0]
-            # Verify abbreviated and full name are consistent
-            if device_id_new[:20] == device_id:
-                return device_id_new
-            else:
-                # Else return the original device_id
-                return device_id
-
         lldp = {}
         command = 'show lldp neighbors'
         output = self._send_command(command)
@@ -834,19 +868,90 @@ class IOSDriver(NetworkDriver):
                         local_int_brief, hold_time, remote_port = remaining_fields.split()
                     else:
                         raise ValueError("Unable to parse LLDP Info:\n{}".format(lldp_entry))
-
-            # device_id might be abbreviated, try to get full name
-            if len(device_id) == 20:
-                if expand_name:
-                    device_id = _device_id_expand(device_id, local_int_brief)
             local_port = canonical_interface_name(local_int_brief)
 
             entry = {'port': remote_port, 'hostname': device_id}
             lldp.setdefault(local_port, [])
             lldp[local_port].append(entry)
 
+        # device_id might be abbreviated (20 chars), the full names come from a single
+        # 'show lldp neighbors detail' instead of one command per interface
+        abbreviated = [entry for entries in lldp.values() for entry in entries
+                       if len(entry['hostname']) == 20]
+        if expand_name and abbreviated:
+            lldp_detail = self._get_lldp_detail_index(lldp_neighbors=lldp)
+            system_names = {}
+            for local_intf, lldp_entries in lldp_detail.items():
+                for lldp_entry in lldp_entries:
+                    for system_name in re.findall(r"System Name\s*?[:-]\s+(.+)", lldp_entry):
+                        system_names.setdefault(local_intf, []).append(system_name.strip())
+            for local_port, entries in lldp.items():
+                for entry in entries:
+                    if len(entry['hostname']) != 20:
+                        continue
+                    # Verify abbreviated and full name are consistent, else keep the original
+                    for system_name in system_names.get(local_port, []):
+                        if system_name[:20] == entry['hostname']:
+                            entry['hostname'] = system_name
+                            break
+
         return lldp
 
+    def _get_lldp_detail_index(self, lldp_neighbors=None):
+        """
+        Run 'show lldp neighbors detail' once and split its entries by local interface.
+
+        Returns {canonical local interface: [lldp_entry, ...]}, entries whose local interface
+        cannot be determined are under None. Older IOS have no 'Local Intf' in the detail output:
+        the local interface is found through 'show lldp neighbors' (lldp_neighbors, if already
+        parsed with expand_name=False).
+        """
+        lldp_detail = {}
+        command = 'show lldp neighbors detail'
+        lldp_detail_output = self._send_command(command)
+
+        # Check if router supports the command
+        if '% Invalid input' in lldp_detail_output:
+            return {}
+        lldp_entries = re.split(r"^------------------.*$", lldp_detail_output, flags=re.M)[1:]
+
+        # Newer IOS versions have 'Local Intf' defined in LLDP detail; older IOS doesn't :-(
+        local_intf_detected = True
+        if not re.search(r"^Local Intf:\s+(\S+)\s*$", lldp_detail_output, flags=re.M):
+            # Older IOS local interface is not in LLDP detail output
+            local_intf_detected = False
+
+            # Construct table of reverse mappings (table to try to work out local_intf)
+            if lldp_neighbors is None:
+                lldp_neighbors = self._get_lldp_neighbors(expand_name=False)
+            reverse_neighbors = {}
+            for local_intf, v in lldp_neighbors.items():
+                for entry in v:
+                    key = "{}_{}".format(entry['hostname'][:20].strip(), entry['port'])
+                    reverse_neighbors[key] = local_intf
+
+        local_intf = None
+        for lldp_entry in lldp_entries:
+            if local_intf_detected:
+                match = re.search(r"^Local Intf:\s+(\S+)\s*$", lldp_entry, flags=re.M)
+                if match:
+                    local_intf = canonical_interface_name(match.group(1))
+            else:
+                system_name_match = re.search(r"^System Name:\s+(\S.*)$", lldp_entry, flags=re.M)
+                port_id_match = re.search(r"^Port id:\s+(\S+)\s*$", lldp_entry, flags=re.M)
+                # Try to find the local_intf from the reverse_neighbors table
+                local_intf = None
+                if system_name_match and port_id_match:
+                    port_id = port_id_match.group(1)
+                    system_name = system_name_match.group(1)[:20]
+                    system_name = system_name.strip()
+                    key = "{}_{}".format(system_name, port_id)
+                    local_intf = reverse_neighbors.get(key)
+            lldp_detail.setdefault(local_intf, [])
+            lldp_detail[local_intf].append(lldp_entry)
+
+        return lldp_detail
+
     def _lldp_detail_parser(self, interface, lldp_entry=None):
         if lldp_entry is None:
             command = "show lldp neighbors {} detail".format(interface)
@@ -886,87 +991,60 @@ class IOSDriver(NetworkDriver):
     def get_lldp_neighbors_detail(self, interface=''):
         """IOS implementation of get_lldp_neighbors_detail."""
         lldp = {}
-        command = 'show lldp neighbors detail'
-        # Filter to specific interface
+        # A single command for all the interfaces, filtered here
+        lldp_detail = self._get_lldp_detail_index()
         if interface:
-            command = 'show lldp neighbors {} detail'.format(interface)
-
-        lldp_detail_output = self._send_command(command)
-        lldp_detail = re.split(r"^------------------.*$", lldp_detail_output, flags=re.M)[1:]
-
-        # Newer IOS versions have 'Local Intf' defined in LLDP detail; older IOS doesn't :-(
-        local_intf_detected = True
-        if not re.search(r"^Local Intf:\s+(\S+)\s*$", lldp_detail_output, flags=re.M):
-            # Older IOS local interface is not in LLDP detail output
-            local_intf_detected = False
-
-            # Construct table of reverse mappings (table to try to work out local_intf)
-            lldp_neighbors = self._get_lldp_neighbors(expand_name=False)
-            reverse_neighbors = {}
-            for local_intf, v in lldp_neighbors.items():
-                for entry in v:
-                    key = "{hostname}_{port}".format(**entry)
-                    reverse_neighbors[key] = local_intf
-
-        for lldp_entry in lldp_detail:
-            if local_intf_detected:
-                match = re.search(r"^Local Intf:\s+(\S+)\s*$", lldp_entry, flags=re.M)
-                if match:
-                    local_intf = match.group(1)
-            else:
-                system_name_match = re.search(r"^System Name:\s+(\S.*)$", lldp_entry, flags=re.M)
-                port_id_match = re.search(r"^Port id:\s+(\S+)\s*$", lldp_entry, flags=re.M)
-                # Try to find the local_intf from the reverse_neighbors table
-                if system_name_match and port_id_match:
-                    port_id = port_id_match.group(1)
-                    system_name = system_name_match.group(1)[:20]
-                    system_name = system_name.strip()
-                    key = "{}_{}".format(system_name, port_id)
-                    local_intf = reverse_neighbors.get(key)
-
-            if local_intf is not None:
-                lldp_fields = self._lldp_detail_parser(local_intf, lldp_entry=lldp_entry)
-            else:
+            interface = canonical_interface_name(interface)
+            unresolved = lldp_detail.get(None, [])
+            lldp_detail = dict((k, v) for k, v in lldp_detail.items() if k == interface)
+            if unresolved:
+                # Unresolved entries may belong to this interface if 'show lldp neighbors'
+                # lists more neighbors on it: then ask the device for this interface only
+                lldp_neighbors = self._get_lldp_neighbors(expand_name=False)
+                if len(lldp_neighbors.get(interface, [])) > len(lldp_detail.get(interface, [])):
+                    lldp_detail = {interface: [None]}
+
+        for local_intf, lldp_entries in lldp_detail.items():
+            if local_intf is None:
                 # Couldn't work out the local interface
                 raise ValueError("LLDP details could not determine the value of local interface:"
-                                 "\n{}\n{}".format(lldp_neighbors, lldp_entry))
-
-            # Convert any 'not advertised' to 'N/A'
-            for field in lldp_fields:
-                for i, value in enumerate(field):
-                    if 'not advertised' in value:
-                        field[i] = 'N/A'
-            number_entries = len(lldp_fields[0])
-
-            # re.findall will return a list. Make sure same number of entries always returned.
-            for test_list in lldp_fields:
-                if len(test_list) != number_entries:
-                    raise ValueError("Failure processing show lldp neighbors detail")
-
-            # Standardize the fields
-            port_id, port_description, chassis_id, system_name, system_description, \
-                system_capabilities, enabled_capabilities, remote_address = lldp_fields
-            standardized_fields = zip(port_id, port_description, chassis_id, system_name,
-                                      system_description, system_capabilities,
-                                      enabled_capabilities, remote_address)
-
-            if local_intf:
-                local_intf = canonical_interface_name(local_intf)
-            lldp.setdefault(local_intf, [])
-            for entry in standardized_fields:
-                remote_port_id, remote_port_description, remote_chassis_id, remote_system_name, \
-                    remote_system_description, remote_system_capab, remote_enabled_capab, \
-                    remote_mgmt_address = entry
-
-                lldp[local_intf].append({
-                    'parent_interface': u'N/A',
-                    'remote_port': remote_port_id,
-                    'remote_port_description': remote_port_description,
-                    'remote_chassis_id': remote_chassis_id,
-                    'remote_system_name': remote_system_name,
-                    'remote_system_description': remote_system_description,
-                    'remote_system_capab': remote_system_capab,
-                    'remote_system_enable_capab': remote_enabled_capab})
+                                 "\n{}".format(lldp_entries[0]))
+            for lldp_entry in lldp_entries:
+                lldp_fields = self._lldp_detail_parser(local_intf, lldp_entry=lldp_entry)
+                # Convert any 'not advertised' to 'N/A'
+                for field in lldp_fields:
+                    for i, value in enumerate(field):
+                        if 'not advertised' in value:
+                            field[i] = 'N/A'
+                number_entries = len(lldp_fields[0])
+
+                # re.findall will return a list. Make sure same number of entries always returned.
+                for test_list in lldp_fields:
+                    if len(test_list) != number_entries:
+                        raise ValueError("Failure processing show lldp neighbors detail")
+
+                # Standardize the fields
+                port_id, port_description, chassis_id, system_name, system_description, \
+                    system_capabilities, enabled_capabilities, remote_address = lldp_fields
+                standardized_fields = zip(port_id, port_description, chassis_id, system_name,
+                                          system_description, system_capabilities,
+                                          enabled_capabilities, remote_address)
+
+                lldp.setdefault(local_intf, [])
+                for entry in standardized_fields:
+                    remote_port_id, remote_port_description, remote_chassis_id, remote_system_name, \
+                        remote_system_description, remote_system_capab, remote_enabled_capab, \
+                        remote_mgmt_address = entry
+
+                    lldp[local_intf].append({
+                        'parent_interface': u'N/A',
+                        'remote_port': remote_port_id,
+                        'remote_port_description': remote_port_description,
+                        'remote_chassis_id': remote_chassis_id,
+                        'remote_system_name': remote_system_name,
+                        'remote_system_description': remote_system_description,
+                        'remote_system_capab': remote_system_capab,
+                        'remote_system_enable_capab': remote_enabled_capab})
 
         return lldp
 
@@ -1101,69 +1179,107 @@ class IOSDriver(NetworkDriver):
         command = 'show interfaces'
         output = self._send_command(command)
 
-        interface = description = mac_address = speed = speedformat = ''
-        is_enabled = is_up = None
-
         interface_dict = {}
-        for line in output.splitlines():
+        for interface, block in self._parse_show_interfaces(output).items():
+            # Blocks without the MTU line are not interfaces
+            if block['speed'] is None:
+                continue
+            interface_dict[interface] = {'is_enabled': block['is_enabled'], 'is_up': block['is_up'],
+                                         'description': block['description'],
+                                         'mac_address': block['mac_address'],
+                                         'last_flapped': last_flapped, 'speed': block['speed']}
 
-            interface_regex_1 = r"^(\S+?)\s+is\s+(.+?),\s+line\s+protocol\s+is\s+(\S+)"
-            interface_regex_2 = r"^(\S+)\s+is\s+(up|down)"
-            for pattern in (interface_regex_1, interface_regex_2):
-                interface_match = re.search(pattern, line)
-                if interface_match:
-                    interface = interface_match.group(1)
-                    status = interface_match.group(2)
-                    try:
-                        protocol = interface_match.group(3)
-                    except IndexError:
-                        protocol = ''
-                    if 'admin' in status.lower():
-                        is_enabled = False
-                    else:
-                        is_enabled = True
-                    if protocol:
-                        is_up = bool('up' in protocol)
-                    else:
-                        is_up = bool('up' in status)
-                    break
+        return interface_dict
 
-            mac_addr_regex = r"^\s+Hardware.+address\s+is\s+({})".format(MAC_REGEX)
-            if re.search(mac_addr_regex, line):
-                mac_addr_match = re.search(mac_addr_regex, line)
-                mac_address = napalm.base.helpers.mac(mac_addr_match.groups()[0])
-
-            descr_regex = r"^\s+Description:\s+(.+?)$"
-            if re.search(descr_regex, line):
-                descr_match = re.search(descr_regex, line)
-                description = descr_match.groups()[0]
-
-            speed_regex = r"^\s+MTU\s+\d+.+BW\s+(\d+)\s+([KMG]?b)"
-            if re.search(speed_regex, line):
-                speed_match = re.search(speed_regex, line)
-                speed = speed_match.groups()[0]
-                speedformat = speed_match.groups()[1]
-                speed = float(speed)
-                if speedformat.startswith('Kb'):
-                    speed = speed / 1000.0
-                elif speedformat.startswith('Gb'):
-                    speed = speed * 1000
-                speed = int(round(speed))
-
-                if interface == '':
-                    raise ValueError("Interface attributes were \
-                                      found without any known interface")
-                if not isinstance(is_up, bool) or not isinstance(is_enabled, bool):
-                    raise ValueError("Did not correctly find the interface status")
-
-                interface_dict[interface] = {'is_enabled': is_enabled, 'is_up': is_up,
-                                             'description': description, 'mac_address': mac_address,
-                                             'last_flapped': last_flapped, 'speed': speed}
-
-                interface = description = mac_address = speed = speedformat = ''
-                is_enabled = is_up = None
+    def _parse_show_interfaces(self, output, strict=False):
+        """
+        Parse show interfaces in a single pass, for get_interfaces and get_interfaces_counters.
 
-        return interface_dict
+        Return {interface: block}, each block having is_enabled, is_up, description, mac_address,
+        speed (None without the MTU line) and counters (only those found). With strict, text
+        before the first interface raises ValueError.
+        """
+        interfaces = {}
+        block = counters = None
+        for line in output.splitlines():
+            header = None
+            if line[:1].strip():
+                header = RE_INTERFACE_HEADER.match(line) or RE_INTERFACE_HEADER_NO_PROTOCOL.match(line)
+            if header:
+                status = header.group(2)
+                protocol = header.group(3) if header.lastindex == 3 else ''
+                counters = {}
+                block = interfaces[header.group(1)] = {
+                    'is_enabled': 'admin' not in status.lower(),
+                    'is_up': 'up' in (protocol or status),
+                    'description': '',
+                    'mac_address': '',
+                    'speed': None,
+                    'counters': counters
+                }
+                continue
+            if block is None:
+                if strict and line.strip():
+                    raise ValueError("Unexpected output from: show interfaces")
+                continue
+
+            # Cheap substring tests first, each line is matched by one pattern at most
+            stripped = line.lstrip()
+            if stripped.startswith('Hardware'):
+                match = RE_INTERFACE_MAC.match(line)
+                if match:
+                    block['mac_address'] = napalm.base.helpers.mac(match.group(1))
+            elif stripped.startswith('Description:'):
+                match = RE_INTERFACE_DESCRIPTION.match(line)
+                if match:
+                    block['description'] = match.group(1)
+            elif stripped.startswith('MTU'):
+                match = RE_INTERFACE_SPEED.match(line)
+                if match:
+                    speed = float(match.group(1))
+                    if match.group(2).startswith('Kb'):
+                        speed = speed / 1000.0
+                    elif match.group(2).startswith('Gb'):
+                        speed = speed * 1000
+                    block['speed'] = int(round(speed))
+            elif 'packets input' in line:
+                # '0 packets input, 0 bytes, 0 no buffer'
+                match = RE_INTERFACE_INPUT.search(line)
+                if match:
+                    counters['rx_unicast_packets'] = int(match.group(1))
+                    counters['rx_octets'] = int(match.group(2))
+            elif 'broadcast' in line:
+                # 'Received 0 broadcasts (0 multicasts)'
+                # 'Received 264071 broadcasts (39327 IP multicasts)'
+                # 'Received 338 broadcasts, 0 runts, 0 giants, 0 throttles'
+                match = RE_INTERFACE_BROADCASTS.search(line)
+                if match:
+                    counters['rx_broadcast_packets'] = int(match.group(1))
+                    counters['rx_multicast_packets'] = int(match.group(2) or -1)
+                else:
+                    counters.setdefault('rx_broadcast_packets', -1)
+                    counters.setdefault('rx_multicast_packets', -1)
+            elif 'packets output' in line:
+                # '0 packets output, 0 bytes, 0 underruns'
+                match = RE_INTERFACE_OUTPUT.search(line)
+                if match:
+                    counters['tx_unicast_packets'] = int(match.group(1))
+                    counters['tx_octets'] = int(match.group(2))
+                    counters['tx_broadcast_packets'] = -1
+                    counters['tx_multicast_packets'] = -1
+            elif 'input errors' in line:
+                # '0 input errors, 0 CRC, 0 frame, 0 overrun, 0 ignored'
+                match = RE_INTERFACE_INPUT_ERRORS.search(line)
+                if match:
+                    counters['rx_errors'] = int(match.group(1))
+                    counters['rx_discards'] = -1
+            elif 'output errors' in line:
+                # '0 output errors, 0 collisions, 1 interface resets'
+                match = RE_INTERFACE_OUTPUT_ERRORS.search(line)
+                if match:
+                    counters['tx_errors'] = int(match.group(1))
+                    counters['tx_discards'] = -1
+        return interfaces
 
     def get_interfaces_ip(self):
         """
@@ -1586,77 +1702,18 @@ class IOSDriver(NetworkDriver):
         sh_int_sum_cmd = 'show interface summary'
         sh_int_sum_cmd_out = self._send_command(sh_int_sum_cmd)
 
-        # Break output into per-interface sections
-        interface_strings = re.split(r'.* line protocol is .*', output, flags=re.M)
-        header_strings = re.findall(r'.* line protocol is .*', output, flags=re.M)
-
-        empty = interface_strings.pop(0).strip()
-        if empty:
-            raise ValueError("Unexpected output from: {}".format(command))
-
-        # Parse out the interface names
-        intf = []
-        for intf_line in header_strings:
-            interface, _ = re.split(r" is .* line protocol is ", intf_line)
-            intf.append(interface.strip())
-
-        if len(intf) != len(interface_strings):
-            raise ValueError("Unexpected output from: {}".format(command))
-
-        # Re-join interface names with interface strings
-        for interface, interface_str in zip(intf, interface_strings):
-            counters.setdefault(interface, {})
-            for line in interface_str.splitlines():
-                if 'packets input' in line:
-                    # '0 packets input, 0 bytes, 0 no buffer'
-                    match = re.search(r"(\d+) packets input.* (\d+) bytes", line)
-                    counters[interface]['rx_unicast_packets'] = int(match.group(1))
-                    counters[interface]['rx_octets'] = int(match.group(2))
-                elif 'broadcast' in line:
-                    # 'Received 0 broadcasts (0 multicasts)'
-                    # 'Received 264071 broadcasts (39327 IP multicasts)'
-                    # 'Received 338 broadcasts, 0 runts, 0 giants, 0 throttles'
-                    match = re.search(r"Received (\d+) broadcasts.*(\d+).*multicasts", line)
-                    alt_match = re.search(r"Received (\d+) broadcasts.*", line)
-                    if match:
-                        counters[interface]['rx_broadcast_packets'] = int(match.group(1))
-                        counters[interface]['rx_multicast_packets'] = int(match.group(2))
-                    elif alt_match:
-                        counters[interface]['rx_broadcast_packets'] = int(alt_match.group(1))
-                        counters[interface]['rx_multicast_packets'] = -1
-                    else:
-                        counters[interface]['rx_broadcast_packets'] = -1
-                        counters[interface]['rx_multicast_packets'] = -1
-                elif 'packets output' in line:
-                    # '0 packets output, 0 bytes, 0 underruns'
-                    match = re.search(r"(\d+) packets output.* (\d+) bytes", line)
-                    counters[interface]['tx_unicast_packets'] = int(match.group(1))
-                    counters[interface]['tx_octets'] = int(match.group(2))
-                    counters[interface]['tx_broadcast_packets'] = -1
-                    counters[interface]['tx_multicast_packets'] = -1
-                elif 'input errors' in line:
-                    # '0 input errors, 0 CRC, 0 frame, 0 overrun, 0 ignored'
-                    match = re.search(r"(\d+) input errors", line)
-                    counters[interface]['rx_errors'] = int(match.group(1))
-                    counters[interface]['rx_discards'] = -1
-                elif 'output errors' in line:
-                    # '0 output errors, 0 collisions, 1 interface resets'
-                    match = re.search(r"(\d+) output errors", line)
-                    counters[interface]['tx_errors'] = int(match.group(1))
-                    counters[interface]['tx_discards'] = -1
-            for line in sh_int_sum_cmd_out.splitlines():
-                if interface in line:
-                    # Line is tabular output with columns
-                    # Interface  IHQ  IQD  OHQ  OQD  RXBS  RXPS  TXBS  TXPS  TRTL
-                    # where columns (excluding interface) are integers
-                    regex = r"\b" + interface + \
-                        r"\b\s+(\d+)\s+(?P<IQD>\d+)\s+(\d+)" + \
-                        r"\s+(?P<OQD>\d+)\s+(\d+)\s+(\d+)" + \
-                        r"\s+(\d+)\s+(\d+)\s+(\d+)"
-                    match = re.search(regex, line)
-                    if match:
-                        counters[interface]['rx_discards'] = int(match.group("IQD"))
-                        counters[interface]['tx_discards'] = int(match.group("OQD"))
+        # Input and output queue drops, read once for all the interfaces
+        discards = {}
+        for line in sh_int_sum_cmd_out.splitlines():
+            match = RE_INTERFACE_SUMMARY.match(line)
+            if match:
+                discards[match.group(1)] = (int(match.group(2)), int(match.group(3)))
+
+        for interface, block in self._parse_show_interfaces(output, strict=True).items():
+            counters[interface] = block['counters']
+            if interface in discards:
+                counters[interface]['rx_discards'], counters[interface]['tx_discards'] = \
+                    discards[interface]
 
         return counters
 
@@ -1924,126 +1981,68 @@ class IOSDriver(NetworkDriver):
         All    1111.2222.3333    STATIC      CPU
         """
 
-        RE_MACTABLE_DEFAULT = r"^" + MAC_REGEX
-        RE_MACTABLE_6500_1 = r"^\*\s+{}\s+{}\s+".format(VLAN_REGEX, MAC_REGEX)  # 7 fields
-        RE_MACTABLE_6500_2 = r"^{}\s+{}\s+".format(VLAN_REGEX, MAC_REGEX)   # 6 fields
-        RE_MACTABLE_6500_3 = r"^\s{51}\S+"                               # Fill down from prior
-        RE_MACTABLE_4500_1 = r"^{}\s+{}\s+".format(VLAN_REGEX, MAC_REGEX)     # 5 fields
-        RE_MACTABLE_4500_2 = r"^\s{32}\S+"                               # Fill down from prior
-        RE_MACTABLE_2960_1 = r"^All\s+{}".format(MAC_REGEX)
-        RE_MACTABLE_GEN_1 = r"^{}\s+{}\s+".format(VLAN_REGEX, MAC_REGEX)   # 4 fields (2960/4500)
-
-        def process_mac_fields(vlan, mac, mac_type, interface):
-            """Return proper data for mac address fields."""
-            if mac_type.lower() in ['self', 'static', 'system']:
-                static = True
-                if vlan.lower() == 'all':
-                    vlan = 0
-                if interface.lower() == 'cpu' or re.search(r'router', interface.lower()) or \
-                        re.search(r'switch', interface.lower()):
-                    interface = ''
-            else:
-                static = False
-            if mac_type.lower() in ['dynamic']:
-                active = True
-            else:
-                active = False
-            return {
-                'mac': napalm.base.helpers.mac(mac),
-                'interface': self._canonical_int(interface),
-                'vlan': int(vlan),
-                'static': static,
-                'active': active,
-                'moves': -1,
-                'last_move': -1.0
-            }
+        return list(self.iter_mac_address_table())
 
-        mac_address_table = []
-        command = IOS_COMMANDS['show_mac_address']
-        output = self._send_command(command)
+    def iter_mac_address_table(self):
+        """
+        Yield the entries of get_mac_address_table() one at a time.
 
-        # Skip the header lines
-        output = re.split(r'^----.*', output, flags=re.M)[1:]
-        output = "\n".join(output).strip()
-        # Strip any leading astericks
-        output = re.sub(r"^\*", "", output, flags=re.M)
-        fill_down_vlan = fill_down_mac = fill_down_mac_type = ''
+        The layout of the rows is detected once from the header of each section (Cat 4500 prints
+        unicast and multicast entries with different headers), then each row is matched by a
+        single precompiled pattern. Interface names are canonicalized once per table.
+        """
+        output = self._send_command(IOS_COMMANDS['show_mac_address'])
+        row_regex = None
+        interfaces = {}
+        vlan = mac = mac_type = None
         for line in output.splitlines():
-            # Cat6500 one off anf 4500 multicast format
-            if (re.search(RE_MACTABLE_6500_3, line) or re.search(RE_MACTABLE_4500_2, line)):
-                interface = line.strip()
-                if ',' in interface:
-                    interfaces = interface.split(',')
-                else:
-                    interfaces = []
-                    interfaces.append(interface)
-                for single_interface in interfaces:
-                    mac_address_table.append(process_mac_fields(fill_down_vlan, fill_down_mac,
-                                                                fill_down_mac_type,
-                                                                single_interface))
-                continue
-            line = line.strip()
-            if line == '':
-                continue
-            if re.search(r"^---", line):
-                # Convert any '---' to VLAN 0
-                line = re.sub(r"^---", "0", line, flags=re.M)
-
-            # Format1
-            if re.search(RE_MACTABLE_DEFAULT, line):
-                if len(line.split()) == 4:
-                    mac, mac_type, vlan, interface = line.split()
-                    mac_address_table.append(process_mac_fields(vlan, mac, mac_type, interface))
-                else:
-                    raise ValueError("Unexpected output from: {}".format(line.split()))
-            # Cat6500 format
-            elif (re.search(RE_MACTABLE_6500_1, line) or re.search(RE_MACTABLE_6500_2, line)) and \
-                    len(line.split()) >= 6:
-                if len(line.split()) == 7:
-                    _, vlan, mac, mac_type, _, _, interface = line.split()
-                elif len(line.split()) == 6:
-                    vlan, mac, mac_type, _, _, interface = line.split()
-                if ',' in interface:
-                    interfaces = interface.split(',')
-                    fill_down_vlan = vlan
-                    fill_down_mac = mac
-                    fill_down_mac_type = mac_type
-                    for single_interface in interfaces:
-                        mac_address_table.append(process_mac_fields(vlan, mac, mac_type,
-                                                                    single_interface))
-                else:
-                    mac_address_table.append(process_mac_fields(vlan, mac, mac_type, interface))
-            # Cat4500 format
-            elif re.search(RE_MACTABLE_4500_1, line) and len(line.split()) == 5:
-                vlan, mac, mac_type, _, interface = line.split()
-                mac_address_table.append(process_mac_fields(vlan, mac, mac_type, interface))
-            # Cat2960 format - ignore extra header line
-            elif re.search(r"^Vlan\s+Mac Address\s+", line):
-                continue
-            # Cat2960 format (Cat4500 format multicast entries)
-            elif (re.search(RE_MACTABLE_2960_1, line) or re.search(RE_MACTABLE_GEN_1, line)) and \
-                    len(line.split()) == 4:
-                vlan, mac, mac_type, interface = line.split()
-                if ',' in interface:
-                    interfaces = interface.split(',')
-                    fill_down_vlan = vlan
-                    fill_down_mac = mac
-                    fill_down_mac_type = mac_type
-                    for single_interface in interfaces:
-                        mac_address_table.append(process_mac_fields(vlan, mac, mac_type,
-                                                                    single_interface))
+            row = row_regex.match(line) if row_regex else None
+            if row:
+                vlan, mac, mac_type, ports = row.group('vlan', 'mac', 'type', 'ports')
+            elif RE_MACTABLE_HEADER.match(line):
+                header = line.lower()
+                if 'destination' in header:
+                    row_regex = RE_MACTABLE_ROWS['default']
+                elif 'learn' in header:
+                    row_regex = RE_MACTABLE_ROWS['6500']
+                elif 'protocols' in header:
+                    row_regex = RE_MACTABLE_ROWS['4500']
                 else:
-                    mac_address_table.append(process_mac_fields(vlan, mac, mac_type, interface))
-            elif re.search(r"Total Mac Addresses", line):
+                    row_regex = RE_MACTABLE_ROWS['2960']
                 continue
-            elif re.search(r"Multicast Entries", line):
-                continue
-            elif re.search(r"vlan.*mac.*address.*type.*", line):
+            elif mac and RE_MACTABLE_CONTINUATION.match(line):
+                ports = line.strip()
+            elif row_regex is None or not line.strip() or RE_MACTABLE_SKIP.match(line):
+                # Before the first header: title, legend
                 continue
             else:
                 raise ValueError("Unexpected output from: {}".format(repr(line)))
 
-        return mac_address_table
+            mac_type = mac_type.lower()
+            static = mac_type in ['self', 'static', 'system']
+            if vlan == '---' or (static and vlan.lower() == 'all'):
+                vlan_id = 0
+            else:
+                vlan_id = int(vlan)
+            mac_hex = mac.replace('.', '').upper()
+            mac_address = ':'.join([mac_hex[i:i + 2] for i in range(0, 12, 2)])
+            for port in ports.split(','):
+                if not port:
+                    continue
+                if static and (port.lower() == 'cpu' or 'router' in port.lower() or
+                               'switch' in port.lower()):
+                    port = ''
+                if port not in interfaces:
+                    interfaces[port] = self._canonical_int(port)
+                yield {
+                    'mac': mac_address,
+                    'interface': interfaces[port],
+                    'vlan': vlan_id,
+                    'static': static,
+                    'active': mac_type == 'dynamic',
+                    'moves': -1,
+                    'last_move': -1.0
+                }
 
     def get_probes_config(self):
         probes = {}
@@ -2454,3 +2453,89 @@ class IOSDriver(NetworkDriver):
         if self.device and self._dest_file_system is None:
             self._dest_file_system = self._discover_file_system()
         return self._dest_file_system
+
+
+class IOSOutputDriver(IOSDriver):
+    """
+    IOSDriver getters parsing command outputs captured earlier, without a device.
+
+    outputs is a dict {command: output}; a command missing from it raises CommandErrorException,
+    so the getter needing it fails instead of parsing a made-up output.
+    """
+
+    def __init__(self, hostname, outputs, optional_args=None):
+        """Parser for the outputs captured from hostname."""
+        IOSDriver.__init__(self, hostname, '', '', optional_args=optional_args)
+        self.outputs = outputs
+
+    def open(self):
+        """Nothing to open."""
+        pass
+
+    def close(self):
+        """Nothing to close."""
+        pass
+
+    def is_alive(self):
+        """Always alive."""
+        return {'is_alive': True}
+
+    def _read_output(self, command):
+        """Captured output of command, None if not captured."""
+        return self.outputs.get(command)
+
+    def _send_command(self, command):
+        """Return the captured output, trying each command of a list until one was captured."""
+        commands = command if isinstance(command, list) else [command]
+        for cmd in commands:
+            output = self._read_output(cmd)
+            if output is not None:
+                return self._send_command_postprocess(output)
+        raise CommandErrorException("{} not captured".format(commands[0]))
+
+
+class IOSReplayDriver(IOSOutputDriver):
+    """
+    IOSDriver getters parsing command outputs saved in a directory, without a device.
+
+    Each output is read from the file named by command_filename(), as saved by the Ansible roles
+    in devices/<host>/ and by discovery_with_napalm.py --raw. Files are read on first use, so only
+    the outputs needed by the called getters are loaded. Commands without a file of their own are
+    looked up in the sections of the saved show tech-support, if any.
+    """
+
+    def __init__(self, hostname, path, optional_args=None):
+        """Parser for the outputs saved in path."""
+        IOSOutputDriver.__init__(self, hostname, {}, optional_args=optional_args)
+        self.path = path
+        self._tech_support = None
+
+    def _read_file(self, command):
+        """Content of the file saved for command, None if missing."""
+        for filename in [command_filename(command)] + REPLAY_FILENAMES.get(command, []):
+            try:
+                with open(os.path.join(self.path, filename)) as output_file:
+                    return output_file.read()
+            except (IOError, OSError):
+                continue
+        return None
+
+    def _read_tech_support(self):
+        """Sections of the saved show tech-support as {command: output}, read once."""
+        if self._tech_support is None:
+            self._tech_support = {}
+            output = self._read_file('show tech-support')
+            if output:
+                sections = RE_TECH_SUPPORT_SECTION.split(output)
+                for i in range(1, len(sections) - 1, 2):
+                    self._tech_support.setdefault(sections[i].strip(), sections[i + 1].strip("\r\n"))
+        return self._tech_support
+
+    def _read_output(self, command):
+        """Saved output of command, None if not saved."""
+        if command not in self.outputs:
+            output = self._read_file(command)
+            if output is None:
+                output = self._read_tech_support().get(command)
+            self.outputs[command] = output
+        return self.outputs[command]
@@ -4,38 +4,279 @@ __copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
 __license__ = 'https://www.gnu.org/licenses/gpl.html'
 __revision__ = '20170329'
 
-import napalm
+import concurrent.futures, glob, napalm, queue, shutil, tempfile, threading
 from functions import *
 
-def main():
-    # Reading options
-    hosts, working_dir = checkOpts()
+# The IOS parsers used by --raw are in old/napalm_ios.py
+sys.path.append('{}/../old'.format(os.path.dirname(os.path.abspath(__file__))))
+
+# Saved file and NAPALM getter
+napalm_getters = [
+    ('facts', 'get_facts'),
+    ('interfaces', 'get_interfaces'),
+    ('interfaces_ip', 'get_interfaces_ip'),
+    ('arp_table', 'get_arp_table'),
+    ('mac_address_table', 'get_mac_address_table'),
+    ('lldp_neighbors', 'get_lldp_neighbors_detail')
+]
+# --raw --ndjson: getters of old/napalm_ios.py yielding the entries, written while parsed
+napalm_iter_getters = {
+    'mac_address_table': 'iter_mac_address_table'
+}
+
+# --raw: commands run by the getters above, captured before parsing (alternatives in a list)
+raw_drivers = ['ios']
+raw_commands = [
+    'show version',
+    'show hosts',
+    'show ip interface brief',
+    'show interfaces',
+    'show ip interface',
+    'show ipv6 interface',
+    'show arp | exclude Incomplete',
+    ['show mac-address-table', 'show mac address-table'],
+    'show lldp neighbors detail',
+    'show lldp neighbors'
+]
 
-    # Discover each host
-    for host in hosts:
-        device_info = {}
+def instrumentDevice(device, metrics):
+    # Counts commands and output bytes of netmiko based drivers, accounted to the running getter
+    connection = getattr(device, 'device', None)
+    send_command = getattr(connection, 'send_command', None)
+    if not callable(send_command):
+        return
+    def countingSendCommand(*args, **kwargs):
+        metrics.count('commands')
+        output = send_command(*args, **kwargs)
+        if isinstance(output, str):
+            metrics.count('bytes', len(output))
+        return output
+    connection.send_command = countingSendCommand
+
+def captureOutputs(device, raw_dir, errors, metrics, deadline):
+    # Outputs are saved as they are, parsing waits for the session to be closed. They are captured
+    # in a fresh directory renamed to raw_dir at the end: outputs of a previous run are never
+    # parsed as current, and a capture still running is never seen in raw_dir
+    from napalm_ios import command_filename
+    os.makedirs(os.path.dirname(raw_dir), exist_ok = True)
+    for path in glob.glob('{}/.{}.*'.format(os.path.dirname(raw_dir), glob.escape(os.path.basename(raw_dir)))):
+        # Left by a previous run exiting during the capture
+        shutil.rmtree(path, ignore_errors = True)
+    capture_dir = tempfile.mkdtemp(prefix = '.{}.'.format(os.path.basename(raw_dir)), dir = os.path.dirname(raw_dir))
+    try:
+        for commands in raw_commands:
+            commands = commands if isinstance(commands, list) else [commands]
+            if time.time() > deadline:
+                errors[commands[0]] = 'skipped, host timeout reached'
+                continue
+            for command in commands:
+                try:
+                    with metrics.measure('capture'):
+                        output = device.cli([command])[command]
+                except Exception as err:
+                    # Not supported by the device, the next alternative is tried
+                    errors[commands[0]] = str(err) or type(err).__name__
+                    continue
+                errors.pop(commands[0], None)
+                output_file = open('{}/{}'.format(capture_dir, command_filename(command)), 'w+')
+                output_file.write(output)
+                output_file.close()
+                break
+        shutil.rmtree(raw_dir, ignore_errors = True)
+        os.rename(capture_dir, raw_dir)
+    except Exception as err:
+        shutil.rmtree(capture_dir, ignore_errors = True)
+        raise
+    return True
+
+def parseOutputs(host, raw_dir, working_dir, ndjson = False):
+    # Runs in a parse process pool, the getters of old/napalm_ios.py read the saved outputs
+    from napalm_ios import IOSReplayDriver
+    device_info = {}
+    errors = {}
+    metrics = CollectorMetrics()
+    device = IOSReplayDriver(host, raw_dir)
+    if device._read_output('show version') is None:
+        # No hostname to save the other getters under
+        return None, {'facts': 'show version not saved'}, {}
+    hostname = None
+    for key, getter in napalm_getters:
         try:
-            ansible_host = host.vars['ansible_host']
-            ansible_username = host.vars['ansible_username']
-            ansible_password = host.vars['ansible_password']
-            napalm_driver = host.vars['napalm_driver']
+            with metrics.measure(key):
+                if ndjson and hostname and key in napalm_iter_getters:
+                    # The table is never held in memory as a whole
+                    writeDeviceTable(getattr(device, napalm_iter_getters[key])(), '{}/{}'.format(working_dir, hostname), key)
+                else:
+                    device_info[key] = getattr(device, getter)()
         except Exception as err:
-            logger.warning('skipping host "{}" because ansible_host, ansible_username, ansible_password and/or napalm_driver are not set in inventory file'.format(host.vars['ansible_host']))
-            continue
+            logger.warning('cannot parse "{}" output of host "{}"'.format(getter, host), exc_info = logger.isEnabledFor(logging.DEBUG))
+            errors[key] = str(err) or type(err).__name__
+        if key == 'facts' and device_info.get('facts', {}).get('hostname'):
+            hostname = device_info['facts']['hostname'].lower()
+            os.makedirs('{}/{}'.format(working_dir, hostname), exist_ok = True)
+    if hostname:
+        writeDeviceInfo(device_info, '{}/{}'.format(working_dir, hostname), ndjson)
+    return hostname, errors, metrics.getMetrics()
 
-        logger.debug('connecting to "{}"'.format(host.vars['ansible_host']))
+def discoverHost(host_vars, device_info, errors, metrics, deadline, raw_dir = None):
+    # Runs in its own thread, filling device_info and errors: what is there when the thread ends
+    # (or when the host budget runs out) is saved by discoverJobs(). With raw_dir, outputs are
+    # captured there instead, to be parsed by parseOutputs(): True is returned once they are complete
+    try:
+        ansible_host = host_vars['ansible_host']
+        ansible_username = host_vars['ansible_username']
+        ansible_password = host_vars['ansible_password']
+        napalm_driver = host_vars['napalm_driver']
+    except Exception as err:
+        logger.warning('skipping host "{}" because ansible_host, ansible_username, ansible_password and/or napalm_driver are not set in inventory file'.format(host_vars.get('ansible_host')))
+        errors['inventory'] = 'ansible_host, ansible_username, ansible_password and/or napalm_driver not set'
+        return False
+
+    logger.debug('connecting to "{}"'.format(ansible_host))
+    try:
         driver = napalm.get_network_driver(napalm_driver)
         device = driver(hostname = ansible_host, username = ansible_username, password = ansible_password, optional_args = {'port': 22})
-        device.open()
-        device_info['facts'] = device.get_facts()
-        device_info['interfaces'] = device.get_interfaces()
-        device_info['interfaces_ip'] = device.get_interfaces_ip()
-        device_info['get_arp_table'] = device.get_arp_table()
-        device_info['mac_address_table'] = device.get_mac_address_table()
-        device_info['lldp_neighbors'] = device.get_lldp_neighbors_detail()
-        device.close()
-
-        writeDeviceInfo(device_info, '{}/{}'.format(working_dir, device_info['facts']['hostname'].lower()))
+        with metrics.measure('open'):
+            device.open()
+    except Exception as err:
+        logger.error('cannot connect to host "{}"'.format(ansible_host), exc_info = True)
+        errors['open'] = str(err) or type(err).__name__
+        return False
+    instrumentDevice(device, metrics)
+
+    # A failing getter does not stop the others, getters are not started after the deadline
+    for key, getter in [] if raw_dir else napalm_getters:
+        if time.time() > deadline:
+            errors[key] = 'skipped, host timeout reached'
+            continue
+        try:
+            with metrics.measure(key):
+                device_info[key] = getattr(device, getter)()
+        except Exception as err:
+            logger.warning('getter "{}" failed on host "{}"'.format(getter, ansible_host), exc_info = logger.isEnabledFor(logging.DEBUG))
+            errors[key] = str(err) or type(err).__name__
+    captured = captureOutputs(device, raw_dir, errors, metrics, deadline) if raw_dir else False
+    try:
+        with metrics.measure('close'):
+            device.close()
+    except Exception as err:
+        logger.debug('cannot close connection to host "{}"'.format(ansible_host), exc_info = True)
+    return captured
+
+def discoverWorker(host, host_vars, state, finished):
+    try:
+        state['captured'] = discoverHost(host_vars, state['device_info'], state['errors'], state['metrics'], state['deadline'], state['raw_dir'])
+    except Exception as err:
+        logger.error('cannot discover host "{}"'.format(host), exc_info = True)
+        state['errors']['host'] = str(err) or type(err).__name__
+    finally:
+        finished.put(host)
+
+def saveHost(state, working_dir, ndjson = False):
+    # Partial results are saved too, as long as get_facts gave the hostname
+    result = {'status': 'failed'}
+    device_info = dict(state['device_info'])
+    if device_info.get('facts', {}).get('hostname'):
+        hostname = device_info['facts']['hostname'].lower()
+        writeDeviceInfo(device_info, '{}/{}'.format(working_dir, hostname), ndjson)
+        result['status'] = 'discovered'
+        result['hostname'] = hostname
+    if state['errors']:
+        result['errors'] = dict(state['errors'])
+    result['elapsed'] = round(time.time() - state['started'], 3)
+    result['metrics'] = {'collectors': state['metrics'].getMetrics()}
+    return result
+
+def discoverJobs(jobs, working_dir, options):
+    # Up to options['concurrency'] hosts at a time, each one in a daemon thread: a host still running
+    # after its timeout (e.g. stuck in device.open()) is saved as it is and abandoned
+    results = {}
+    running = {}
+    parsing = {}
+    finished = queue.Queue()
+    jobs = list(jobs)
+    parser = None
+    if options['raw']:
+        # Captured outputs are parsed on every core, sharing them with the other worker processes
+        parser = concurrent.futures.ProcessPoolExecutor(max_workers = max(1, (os.cpu_count() or 1) // options['workers']), initializer = logger.setLevel, initargs = (logger.level,))
+
+    def finishHost(host):
+        state = running.pop(host)
+        if state['raw_dir'] and state['captured']:
+            # Parsed while the next hosts are captured. Not when the session failed to open or the
+            # host timed out before the capture was complete
+            parsing[host] = (state, parser.submit(parseOutputs, host, state['raw_dir'], working_dir, options['ndjson']))
+        else:
+            results[host] = saveHost(state, working_dir, options['ndjson'])
+
+    while jobs or running:
+        while jobs and len(running) < options['concurrency']:
+            host, host_vars = jobs.pop(0)
+            started = time.time()
+            running[host] = {
+                'started': started,
+                'deadline': started + int(host_vars.get('napalm_timeout', options['host_timeout'])),
+                'device_info': {},
+                'errors': {},
+                'metrics': CollectorMetrics(),
+                'captured': False,
+                'raw_dir': '{}/napalm_raw/{}'.format(os.path.dirname(working_dir), host) if options['raw'] and host_vars.get('napalm_driver') in raw_drivers else None
+            }
+            threading.Thread(target = discoverWorker, args = (host, host_vars, running[host], finished), daemon = True).start()
+        try:
+            host = finished.get(timeout = max(0, min(state['deadline'] for state in running.values()) - time.time()))
+            if host in running:
+                finishHost(host)
+        except queue.Empty:
+            for host, state in list(running.items()):
+                if time.time() >= state['deadline']:
+                    logger.error('host "{}" did not complete in {}s, abandoning it'.format(host, round(state['deadline'] - state['started'])))
+                    state['errors']['timeout'] = 'not completed in {}s'.format(round(state['deadline'] - state['started']))
+                    finishHost(host)
+
+    for host, (state, future) in parsing.items():
+        result = saveHost(state, working_dir, options['ndjson'])
+        try:
+            hostname, errors, collectors = future.result()
+        except Exception as err:
+            logger.error('cannot parse outputs of host "{}"'.format(host), exc_info = True)
+            hostname, errors, collectors = None, {'parse': str(err) or type(err).__name__}, {}
+        if hostname:
+            result['status'] = 'discovered'
+            result['hostname'] = hostname
+        if errors:
+            result.setdefault('errors', {}).update(errors)
+        result['metrics']['collectors'].update(collectors)
+        results[host] = result
+    if parser:
+        parser.shutdown()
+    return results
+
+def logFailures(results):
+    # Failed hosts first, then getters failing on discovered hosts
+    for host, result in sorted(results.items()):
+        if result['status'] == 'failed':
+            logger.warning('host "{}" failed: {}'.format(host, '; '.join('{}: {}'.format(key, error) for key, error in result.get('errors', {}).items()) or 'no facts'))
+    getter_failures = {}
+    for host, result in results.items():
+        if result['status'] != 'failed':
+            for key in result.get('errors', {}):
+                getter_failures.setdefault(key, []).append(host)
+    for key, hosts in sorted(getter_failures.items()):
+        logger.warning('"{}" failed on {} discovered hosts: {}'.format(key, len(hosts), ', '.join(sorted(hosts))))
+
+def main():
+    # Reading options
+    hosts, working_dir, options = checkOpts()
+    started = time.time()
+
+    # Discover each host, optionally splitting them across worker processes
+    jobs = [(host.vars.get('ansible_host', host.name), dict(host.vars)) for host in hosts]
+    results = runWorkers(discoverJobs, jobs, options['workers'], working_dir, options)
+    metrics = dict((host, result.pop('metrics')) for host, result in results.items())
+    logFailures(results)
+    saveRunSummary(getRunFile(working_dir, options, 'discovery_summary.json'), results, started, options)
+    saveRunMetrics(getRunFile(working_dir, options, 'run_metrics.json'), results, metrics, started, 'napalm')
 
 if __name__ == "__main__":
     main()
@@ -4,207 +4,1024 @@ __copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
 __license__ = 'https://www.gnu.org/licenses/gpl.html'
 __revision__ = '20170329'
 
-import pysnmp, re, sys
-from pysnmp.hlapi import *
+import asyncio, heapq, ipaddress, pysnmp, random, re, signal, sys
 from functions import *
+from snmp_functions import *
 
 # Default variables
+sysDescr = '.1.3.6.1.2.1.1.1.0'
+sysObjectID = '.1.3.6.1.2.1.1.2.0'
+sysUpTime = '.1.3.6.1.2.1.1.3.0'
 sysName = '.1.3.6.1.2.1.1.5.0'
+entPhysicalClass = '.1.3.6.1.2.1.47.1.1.1.1.5'
+entPhysicalSerialNum = '.1.3.6.1.2.1.47.1.1.1.1.11'
+entPhysicalModelName = '.1.3.6.1.2.1.47.1.1.1.1.13'
+ifTableLastChange = '.1.3.6.1.2.1.31.1.5.0'
+cdpGlobalLastChange = '.1.3.6.1.4.1.9.9.23.1.3.5.0'
+cdpCacheAddressType = '.1.3.6.1.4.1.9.9.23.1.2.1.1.3'
+cdpCacheAddress = '.1.3.6.1.4.1.9.9.23.1.2.1.1.4'
 cdpCacheDeviceId = '.1.3.6.1.4.1.9.9.23.1.2.1.1.6'
 cdpCacheDevicePort = '.1.3.6.1.4.1.9.9.23.1.2.1.1.7'
 cdpCachePlatform = '.1.3.6.1.4.1.9.9.23.1.2.1.1.8'
 ifDescr = '.1.3.6.1.2.1.2.2.1.2'
+ifName = '.1.3.6.1.2.1.31.1.1.1.1'
 vtpVlanName = '.1.3.6.1.4.1.9.9.46.1.3.1.1.4.1'
+lldpStatsRemTablesLastChangeTime = '.1.0.8802.1.1.2.1.2.1.0'
+lldpLocPortIdSubtype = '.1.0.8802.1.1.2.1.3.7.1.2'
+lldpLocPortId = '.1.0.8802.1.1.2.1.3.7.1.3'
+lldpLocPortDesc = '.1.0.8802.1.1.2.1.3.7.1.4'
+lldpRemChassisIdSubtype = '.1.0.8802.1.1.2.1.4.1.1.4'
+lldpRemChassisId = '.1.0.8802.1.1.2.1.4.1.1.5'
+lldpRemPortIdSubtype = '.1.0.8802.1.1.2.1.4.1.1.6'
+lldpRemPortId = '.1.0.8802.1.1.2.1.4.1.1.7'
+lldpRemPortDesc = '.1.0.8802.1.1.2.1.4.1.1.8'
+lldpRemSysName = '.1.0.8802.1.1.2.1.4.1.1.9'
+lldpRemSysDesc = '.1.0.8802.1.1.2.1.4.1.1.10'
+lldpRemManAddrIfSubtype = '.1.0.8802.1.1.2.1.4.2.1.3'
+ipAdEntIfIndex = '.1.3.6.1.2.1.4.20.1.2'
+ipAdEntNetMask = '.1.3.6.1.2.1.4.20.1.3'
+ipNetToMediaPhysAddress = '.1.3.6.1.2.1.4.22.1.2'
+ipNetToMediaType = '.1.3.6.1.2.1.4.22.1.4'
+ipAddressIfIndex = '.1.3.6.1.2.1.4.34.1.3'
+ipAddressType = '.1.3.6.1.2.1.4.34.1.4'
+ipAddressPrefix = '.1.3.6.1.2.1.4.34.1.5'
+ipNetToPhysicalPhysAddress = '.1.3.6.1.2.1.4.35.1.4'
+ipNetToPhysicalLastUpdated = '.1.3.6.1.2.1.4.35.1.5'
+ipNetToPhysicalType = '.1.3.6.1.2.1.4.35.1.6'
+dot1dBasePortIfIndex = '.1.3.6.1.2.1.17.1.4.1.2'
+dot1dTpFdbPort = '.1.3.6.1.2.1.17.4.3.1.2'
+dot1dTpFdbStatus = '.1.3.6.1.2.1.17.4.3.1.3'
+entity_columns = (entPhysicalClass, entPhysicalSerialNum, entPhysicalModelName)
+cdp_columns = (cdpCacheDeviceId, cdpCacheDevicePort, cdpCachePlatform, cdpCacheAddressType, cdpCacheAddress)
+lldp_loc_columns = (lldpLocPortIdSubtype, lldpLocPortId, lldpLocPortDesc)
+lldp_rem_columns = (lldpRemChassisIdSubtype, lldpRemChassisId, lldpRemPortIdSubtype, lldpRemPortId, lldpRemPortDesc, lldpRemSysName, lldpRemSysDesc)
+# IP-MIB (RFC 4293) tables, the RFC 2011 ones are walked only when the new ones are empty
+arp_columns = (ipNetToPhysicalPhysAddress, ipNetToPhysicalLastUpdated, ipNetToPhysicalType)
+arp_legacy_columns = (ipNetToMediaPhysAddress, ipNetToMediaType)
+address_columns = (ipAddressIfIndex, ipAddressType, ipAddressPrefix)
+address_legacy_columns = (ipAdEntIfIndex, ipAdEntNetMask)
+fdb_columns = (dot1dTpFdbPort, dot1dTpFdbStatus)
 
-def getFacts(host, SNMPAuth):
+# Daemon mode: +/- jitter on each interval, status and inventory checks (seconds)
+poll_jitter = 0.1
+poll_status_interval = 10
+poll_reload_interval = 10
+
+# The chassis is one of the first physical entities, the rest of the table is not walked
+entity_rows = 10
+entity_class_chassis = 3
+
+# ipNetToPhysicalType/ipNetToMediaType invalid(2) and ipAddressType broadcast(3) entries are skipped
+arp_type_invalid = 2
+address_type_broadcast = 3
+
+# BRIDGE-MIB is walked in each VLAN context, with this many requests in flight per device
+# (overridden by snmp_max_vlan_requests); VLANs 1002-1005 (FDDI/Token Ring defaults) have no bridge
+snmp_max_vlan_requests = 4
+reserved_vlans = range(1002, 1006)
+# dot1dTpFdbStatus: learned(3) and mgmt(5) (static) entries are saved, invalid(2) and self(4) are not
+fdb_status_learned = 3
+fdb_status_mgmt = 5
+
+# Vendor by sysObjectID enterprise number, OS and version by the first matching sysDescr rule
+snmp_vendors = {
+    '9': 'Cisco',
+    '11': 'HP',
+    '43': '3Com',
+    '311': 'Microsoft',
+    '674': 'Dell',
+    '1588': 'Brocade',
+    '1916': 'Extreme',
+    '1991': 'Brocade',
+    '2011': 'Huawei',
+    '2636': 'Juniper',
+    '3375': 'F5',
+    '4526': 'Netgear',
+    '6027': 'Dell',
+    '6486': 'Alcatel-Lucent',
+    '6527': 'Nokia',
+    '8072': 'Net-SNMP',
+    '12356': 'Fortinet',
+    '14988': 'MikroTik',
+    '25461': 'Palo Alto Networks',
+    '25506': 'H3C',
+    '30065': 'Arista',
+    '41112': 'Ubiquiti'
+}
+snmp_os_rules = [(re.compile(pattern, re.DOTALL), os_name) for pattern, os_name in [
+    (r'Cisco NX-OS.*?[Vv]ersion ([^\s,]+)', 'nxos'),
+    (r'Cisco IOS XR Software.*?Version ([^\s,\[]+)', 'iosxr'),
+    (r'Cisco IOS.*?(?:IOS-XE|IOSXE|IOS XE).*?Version ([^\s,]+)', 'iosxe'),
+    (r'Cisco (?:Internetwork Operating System|IOS) Software.*?Version ([^\s,]+)', 'ios'),
+    (r'Cisco Adaptive Security Appliance Version ([^\s,]+)', 'asa'),
+    (r'JUNOS ([^\s,]+)', 'junos'),
+    (r'Arista Networks EOS version ([^\s,]+)', 'eos'),
+    (r'Huawei Versatile Routing Platform.*?Version ([^\s,]+)', 'vrp'),
+    (r'Comware Software,? Version ([^\s,]+)', 'comware'),
+    (r'ArubaOS.*?Version ([^\s,]+)', 'arubaos'),
+    (r'FortiGate.*?v([0-9][^\s,]*)', 'fortios'),
+    (r'RouterOS ([^\s,]+)', 'routeros'),
+    (r'^Linux \S+ ([^\s,]+)', 'linux'),
+    (r'^FreeBSD \S+ ([^\s,]+)', 'freebsd')
+]]
+
+# Scalars moving when the device reboots or a table changes (saved in snmp_state.json)
+change_markers = {
+    'sysUpTime': sysUpTime,
+    'ifTableLastChange': ifTableLastChange,
+    'cdpGlobalLastChange': cdpGlobalLastChange,
+    'lldpStatsRemTablesLastChangeTime': lldpStatsRemTablesLastChangeTime
+}
+
+# Incremental runs read the facts and the change markers first
+marker_plan = CollectionPlan()
+for oid in [sysName, sysDescr, sysObjectID]:
+    marker_plan.addScalar(oid)
+for marker in change_markers.values():
+    marker_plan.addScalar(marker)
+marker_plan.addTable(*entity_columns, max_rows = entity_rows)
+
+# Everything the getters need, fetched in as few requests as possible; the interface table is
+# left out when cached, the markers collected in the same pass tell whether the cache is still valid
+cached_discovery_plan = CollectionPlan()
+cached_discovery_plan.extend(marker_plan)
+cached_discovery_plan.addTable(*cdp_columns)
+cached_discovery_plan.addTable(*lldp_loc_columns)
+cached_discovery_plan.addTable(*lldp_rem_columns)
+cached_discovery_plan.addTable(lldpRemManAddrIfSubtype)
+cached_discovery_plan.addTable(vtpVlanName)
+cached_discovery_plan.addTable(*arp_columns)
+cached_discovery_plan.addTable(*address_columns)
+# ifName is not implemented by old devices, so it is walked as a separate table
+interface_plan = CollectionPlan()
+interface_plan.addTable(ifDescr)
+interface_plan.addTable(ifName)
+discovery_plan = CollectionPlan()
+discovery_plan.extend(interface_plan)
+discovery_plan.extend(cached_discovery_plan)
+
+async def getFacts(session):
     output = {}
     try:
-        errorIndication, errorStatus, errorIndex, varBinds = next(
-            getCmd(SnmpEngine(),
-                SNMPAuth,
-                UdpTransportTarget((host, 161)),
-                ContextData(),
-                ObjectType(ObjectIdentity(sysName)),
-                lookupMib = False,
-                lexicographicMode = False
-            )
-        )
+        errorIndication, errorStatus, errorIndex, varBinds = await session.get(sysName, sysDescr, sysObjectID, sysUpTime)
         if errorIndication or errorStatus or errorIndex:
-            logger.debug('error quering SNMP host "{}" for sysName'.format(host))
+            logger.debug('error quering SNMP host "{}" for sysName'.format(session.host))
             return {}
     except Exception as err:
-        logger.debug('cannot query SNMP host "{}" for sysName'.format(host), exc_info = False)
+        logger.debug('cannot query SNMP host "{}" for sysName'.format(session.host), exc_info = False)
         return {}
 
+    description = getScalarString(varBinds[1][1])
+    try:
+        uptime = int(varBinds[3][1]) // 100
+    except Exception as err:
+        uptime = None
     output =  {
-        'uptime': None,
-        'vendor': None,
-        'os_version': None,
+        'uptime': uptime,
+        'vendor': getVendor(varBinds[2][1]),
+        'os_version': getOSVersion(description),
         'serial_number': None,
         'model': None,
         'hostname': str(varBinds[0][1]).split('.')[0],
         'fqdn': str(varBinds[0][1]),
         'interface_list': []
     }
+    output['serial_number'], output['model'] = await getChassis(session)
     return output
 
-def getInterfaces(host, SNMPAuth):
+def getScalarString(value):
+    # noSuchObject/noSuchInstance (not supported) are empty
+    return str(value) or None
+
+def getVendor(object_id):
+    object_id = getScalarString(object_id) or ''
+    if not object_id.startswith('1.3.6.1.4.1.'):
+        return None
+    return snmp_vendors.get(object_id.split('.')[6])
+
+def getOSVersion(description):
+    # NAPALM get_facts has no OS field: the OS goes in os_version, e.g. "ios 15.0(2)SE11"
+    if not description:
+        return None
+    for rule, os_name in snmp_os_rules:
+        match = rule.search(description)
+        if match:
+            return '{} {}'.format(os_name, match.group(1))
+    return None
+
+async def getChassis(session):
+    # Serial number and model of the chassis entity (the first entity with a serial number otherwise)
+    try:
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*entity_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for entPhysicalTable'.format(session.host))
+            return None, None
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for entPhysicalTable'.format(session.host), exc_info = False)
+        return None, None
+
+    entities = [(int(varBinds[0][1]), str(varBinds[1][1]).strip(), str(varBinds[2][1]).strip()) for varBinds in varBindTable]
+    for entity_class, serial_number, model in entities:
+        if entity_class == entity_class_chassis and serial_number:
+            return serial_number, model or None
+    for entity_class, serial_number, model in entities:
+        if serial_number:
+            return serial_number, model or None
+    return None, None
+
+async def getMarkers(session):
+    markers = {}
+    try:
+        errorIndication, errorStatus, errorIndex, varBinds = await session.get(*change_markers.values())
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for change markers'.format(session.host))
+            return {}
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for change markers'.format(session.host), exc_info = False)
+        return {}
+
+    for name, (oid, value) in zip(change_markers.keys(), varBinds):
+        try:
+            markers[name] = int(value)
+        except Exception as err:
+            # Not supported by the device
+            markers[name] = None
+    return markers
+
+def isInterfaceCacheValid(cache, markers):
+    # The interface table did not change and the device did not reboot since the cache was written
+    if not cache or not cache.get('interfaces') or not markers:
+        return False
+    if markers.get('sysUpTime') is None or cache.get('sysUpTime') is None or markers['sysUpTime'] < cache['sysUpTime']:
+        return False
+    return markers.get('ifTableLastChange') is not None and markers['ifTableLastChange'] == cache.get('ifTableLastChange')
+
+def getUnchangedTables(state, markers):
+    # Tables whose change marker did not move since the previous run; nothing is kept after a reboot
+    if not state or not markers:
+        return []
+    previous = state.get('markers', {})
+    if markers.get('sysUpTime') is None or previous.get('sysUpTime') is None or markers['sysUpTime'] < previous['sysUpTime']:
+        return []
+    unchanged = []
+    if markers.get('ifTableLastChange') is not None and markers['ifTableLastChange'] == previous.get('ifTableLastChange'):
+        unchanged.append('interfaces')
+        # CDP and LLDP neighbors are stored by interface name, they depend on the interface table too
+        if markers.get('cdpGlobalLastChange') is not None and markers['cdpGlobalLastChange'] == previous.get('cdpGlobalLastChange'):
+            unchanged.append('cdp_neighbors')
+        if markers.get('lldpStatsRemTablesLastChangeTime') is not None and markers['lldpStatsRemTablesLastChangeTime'] == previous.get('lldpStatsRemTablesLastChangeTime'):
+            unchanged.append('lldp_neighbors')
+    return unchanged
+
+async def getInterfaces(session):
     interfaces = {}
     try:
-        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-            SnmpEngine(),
-            SNMPAuth,
-            UdpTransportTarget((host, 161)),
-            ContextData(),
-            ObjectType(ObjectIdentity(ifDescr)),
-            lookupMib = False,
-            lexicographicMode = False
-        ):
-            if errorIndication or errorStatus or errorIndex:
-                logger.debug('error quering SNMP host "{}" for ifDescr'.format(host))
-                return {}
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(ifDescr)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for ifDescr'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
             interfaces[int(str(varBinds[0][0]).split('.')[-1])] = str(varBinds[0][1])
     except Exception as err:
-        logger.debug('cannot query SNMP host "{}" for ifDescr'.format(host), exc_info = False)
+        logger.debug('cannot query SNMP host "{}" for ifDescr'.format(session.host), exc_info = False)
         return {}
 
     return interfaces
 
-def getCDPNeighbors(host, SNMPAuth, local_interfaces):
+async def getInterfaceNames(session):
+    interface_names = {}
+    try:
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(ifName)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for ifName'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
+            interface_names[int(str(varBinds[0][0]).split('.')[-1])] = str(varBinds[0][1])
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for ifName'.format(session.host), exc_info = False)
+        return {}
+
+    return interface_names
+
+async def getCDPNeighbors(session, local_interfaces):
     neighbors = {}
     local_port = {}
     try:
-        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-            SnmpEngine(),
-            SNMPAuth,
-            UdpTransportTarget((host, 161)),
-            ContextData(),
-            ObjectType(ObjectIdentity(cdpCacheDeviceId)),
-            ObjectType(ObjectIdentity(cdpCacheDevicePort)),
-            ObjectType(ObjectIdentity(cdpCachePlatform)),
-            lookupMib = False,
-            lexicographicMode = False
-        ):
-            if errorIndication or errorStatus or errorIndex:
-                logger.debug('error quering SNMP host "{}" for CDP data'.format(host))
-                return {}
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*cdp_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for CDP data'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
             neighbor_id = int(str(varBinds[0][0]).split('.')[-2])
             neighbors.setdefault(local_interfaces[neighbor_id], [])
             neighbors[local_interfaces[neighbor_id]].append({
                 'remote_system_name': re.findall(r'([^(\n]+).*', str(varBinds[0][1]))[0],
                 'remote_port': str(varBinds[1][1]),
                 'remote_port_description': str(varBinds[1][1]),
-                'remote_system_description': str(varBinds[2][1])
+                'remote_system_description': str(varBinds[2][1]),
+                'remote_management_address': getCDPAddress(varBinds[3][1], varBinds[4][1])
+            })
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for CDP data'.format(session.host), exc_info = False)
+        return {}
+
+    return neighbors
+
+def getCDPAddress(address_type, address):
+    # Only IPv4 addresses (cdpCacheAddressType ip(1)) can be polled
+    try:
+        if int(address_type) == 1 and len(address) == 4:
+            return str(ipaddress.IPv4Address(bytes(address.asNumbers())))
+    except Exception as err:
+        pass
+    return None
+
+def getLLDPId(subtype, value, mac_subtype):
+    # MAC addresses are sent as raw octets, the other subtypes are mostly printable
+    try:
+        if int(subtype) == mac_subtype and len(value) == 6:
+            return ':'.join('{:02x}'.format(octet) for octet in value.asNumbers())
+    except Exception as err:
+        pass
+    return str(value)
+
+async def getLLDPNeighbors(session, local_interfaces, interface_names):
+    neighbors = {}
+    local_ports = {}
+    addresses = {}
+    try:
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*lldp_loc_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for LLDP local ports'.format(session.host))
+            return {}
+        # Local ports are named as in ifDescr when possible, to match CDP neighbors and interface_list
+        descriptions = set(local_interfaces.values())
+        short_names = {name: local_interfaces[interface_id] for interface_id, name in interface_names.items() if interface_id in local_interfaces}
+        for varBinds in varBindTable:
+            port = int(str(varBinds[0][0]).split('.')[-1])
+            port_id = getLLDPId(varBinds[0][1], varBinds[1][1], 3)
+            port_description = str(varBinds[2][1])
+            if port_description in descriptions:
+                local_ports[port] = port_description
+            elif port_id in descriptions:
+                local_ports[port] = port_id
+            elif port_id in short_names:
+                local_ports[port] = short_names[port_id]
+            elif port in local_interfaces:
+                local_ports[port] = local_interfaces[port]
+            else:
+                local_ports[port] = port_description or port_id
+
+        # Management addresses are part of the lldpRemManAddrTable index:
+        # lldpRemTimeMark.lldpRemLocalPortNum.lldpRemIndex.lldpRemManAddrSubtype.length.address
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(lldpRemManAddrIfSubtype)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for LLDP management addresses'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
+            index = [int(i) for i in str(varBinds[0][0])[len(lldpRemManAddrIfSubtype.lstrip('.')) + 1:].split('.')]
+            if index[3] == 1 and index[4] == 4:
+                addresses.setdefault((index[1], index[2]), str(ipaddress.IPv4Address(bytes(index[5:9]))))
+
+        # lldpRemTable is indexed by lldpRemTimeMark.lldpRemLocalPortNum.lldpRemIndex
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*lldp_rem_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for LLDP neighbors'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
+            port, remote_index = [int(i) for i in str(varBinds[0][0]).split('.')[-2:]]
+            local_port = local_ports.get(port, str(port))
+            chassis_id = getLLDPId(varBinds[0][1], varBinds[1][1], 4)
+            neighbors.setdefault(local_port, [])
+            neighbors[local_port].append({
+                'remote_system_name': str(varBinds[5][1]) or chassis_id,
+                'remote_port': getLLDPId(varBinds[2][1], varBinds[3][1], 3),
+                'remote_port_description': str(varBinds[4][1]),
+                'remote_system_description': str(varBinds[6][1]),
+                'remote_chassis_id': chassis_id,
+                'remote_management_address': addresses.get((port, remote_index))
             })
     except Exception as err:
-        logger.debug('cannot query SNMP host "{}" for CDP data'.format(host), exc_info = False)
+        logger.debug('cannot query SNMP host "{}" for LLDP data'.format(session.host), exc_info = False)
         return {}
 
     return neighbors
 
-def getVLANs(host, SNMPAuth):
+async def getVLANs(session):
     vlans = {}
     try:
-        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-            SnmpEngine(),
-            SNMPAuth,
-            UdpTransportTarget((host, 161)),
-            ContextData(),
-            ObjectType(ObjectIdentity(vtpVlanName)),
-            lookupMib = False,
-            lexicographicMode = False
-        ):
-            if errorIndication or errorStatus or errorIndex:
-                logger.debug('error quering SNMP host "{}" for vtpVlanName'.format(host))
-                return {}
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(vtpVlanName)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for vtpVlanName'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
             vlans[int(str(varBinds[0][0]).split('.')[-1])] = str(varBinds[0][1])
     except Exception as err:
-        logger.debug('cannot query SNMP host "{}" for vtpVlanName'.format(host), exc_info = False)
+        logger.debug('cannot query SNMP host "{}" for vtpVlanName'.format(session.host), exc_info = False)
         return {}
 
     return vlans
 
-def main():
-    # Reading options
-    hosts, working_dir = checkOpts()
+def getIndex(oid, column):
+    # Sub-identifiers following the column
+    return [int(i) for i in str(oid)[len(column.lstrip('.')) + 1:].split('.')]
 
-    # Discover each host
-    for host in hosts:
-        device_info = {}
-        snmp_version = host.vars['snmp_version'] if 'snmp_version' in host.vars else None
-        snmp_community = host.vars['snmp_community'] if 'snmp_community' in host.vars else None
-        snmp_auth = host.vars['snmp_auth'] if 'snmp_auth' in host.vars else None
-        snmp_username = host.vars['snmp_username'] if 'snmp_username' in host.vars else None
-        snmp_password = host.vars['snmp_password'] if 'snmp_password' in host.vars else None
-        snmp_priv = host.vars['snmp_priv'] if 'snmp_priv' in host.vars else None
-        snmp_privpassword = host.vars['snmp_privpassword'] if 'snmp_privpassword' in host.vars else None
-
-        if not snmp_version:
-            logging.warning('skipping host "{}" because snmp_version is not set'.format(host.vars['ansible_host']))
-
-        if snmp_version == '2c':
-            try:
-                SNMPAuth = CommunityData(host.vars['snmp_community'])
-            except Exception as err:
-                logging.warning('skipping host "{}" because snmp_community is not set'.format(host.vars['ansible_host'], host.vars['snmp_community']), exc_info = False)
+def getScalarInteger(value):
+    try:
+        return int(value)
+    except Exception as err:
+        # Not supported by the device
+        return None
+
+def getMACAddress(value):
+    # Same format as NAPALM
+    try:
+        if len(value) == 6:
+            return ':'.join('{:02X}'.format(octet) for octet in value.asNumbers())
+    except Exception as err:
+        pass
+    return None
+
+def getInetAddress(address_type, address):
+    # InetAddressType ipv4(1), ipv6(2), ipv4z(3) and ipv6z(4), zoned addresses end with a 4 bytes zone index
+    try:
+        if address_type in [1, 3] and len(address) in [4, 8]:
+            return 'ipv4', str(ipaddress.IPv4Address(bytes(address[:4])))
+        if address_type in [2, 4] and len(address) in [16, 20]:
+            return 'ipv6', str(ipaddress.IPv6Address(bytes(address[:16])))
+    except Exception as err:
+        pass
+    return None, None
+
+async def getARPTable(session, local_interfaces, uptime):
+    arp_table = []
+    try:
+        # ipNetToPhysicalTable is indexed by ifIndex.ipNetToPhysicalNetAddressType.length.address
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*arp_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for ipNetToPhysicalTable'.format(session.host))
+            return []
+        for varBinds in varBindTable:
+            index = getIndex(varBinds[0][0], ipNetToPhysicalPhysAddress)
+            address_family, address = getInetAddress(index[1], index[3:3 + index[2]])
+            mac = getMACAddress(varBinds[0][1])
+            # NAPALM ARP tables are IPv4 only
+            if address_family != 'ipv4' or not mac or getScalarInteger(varBinds[2][1]) == arp_type_invalid:
                 continue
-        elif str(snmp_version) == '3':
-            if not snmp_auth:
-                auth_protocol = usmNoAuthProtocol
-            elif snmp_auth == 'sha' and snmp_username and snmp_password:
-                auth_protocol = usmHMACSHAAuthProtocol
-            elif snmp_auth == 'md5' and snmp_username and snmp_password:
-                auth_protocol = usmHMACMD5AuthProtocol
-            else:
-                logging.warning('skipping host "{}" because snmp_auth, snmp_username or snmp_password are not set/not valid'.format(host.vars['ansible_host']))
+            updated = getScalarInteger(varBinds[1][1])
+            arp_table.append({
+                'interface': local_interfaces.get(index[0], str(index[0])),
+                'mac': mac,
+                'ip': address,
+                'age': max(0, uptime - updated) / 100 if uptime is not None and updated is not None else -1.0
+            })
+        if varBindTable:
+            return arp_table
+
+        # ipNetToMediaTable is indexed by ifIndex.address and has no age
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*arp_legacy_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for ipNetToMediaTable'.format(session.host))
+            return []
+        for varBinds in varBindTable:
+            index = getIndex(varBinds[0][0], ipNetToMediaPhysAddress)
+            mac = getMACAddress(varBinds[0][1])
+            if len(index) != 5 or not mac or getScalarInteger(varBinds[1][1]) == arp_type_invalid:
                 continue
-            if not snmp_priv:
-                priv_protocol = usmNoPrivProtocol
-            elif snmp_priv == 'des' and snmp_privpassword:
-                priv_protocol = usmDESPrivProtocol
-            elif snmp_priv == '3des' and snmp_privpassword:
-                priv_protocol = usm3DESEDEPrivProtocol
-            elif snmp_priv == 'aes128' and snmp_privpassword:
-                priv_protocol = usmAesCfb128Protocol
-            elif snmp_priv == 'aes192' and snmp_privpassword:
-                priv_protocol = usmAesCfb192Protocol
-            elif snmp_priv == 'aes256' and snmp_privpassword:
-                priv_protocol = usmAesCfb256Protocol
-            else:
-                logging.warning('skipping host "{}" because snmp_priv or snmp_privpassword are not set/not valid'.format(host.vars['ansible_host']))
+            arp_table.append({
+                'interface': local_interfaces.get(index[0], str(index[0])),
+                'mac': mac,
+                'ip': str(ipaddress.IPv4Address(bytes(index[1:]))),
+                'age': -1.0
+            })
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for ARP table'.format(session.host), exc_info = False)
+        return []
+
+    return arp_table
+
+async def getInterfacesIP(session, local_interfaces):
+    interfaces_ip = {}
+    try:
+        # ipAddressTable is indexed by ipAddressAddrType.length.address
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*address_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for ipAddressTable'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
+            index = getIndex(varBinds[0][0], ipAddressIfIndex)
+            address_family, address = getInetAddress(index[0], index[2:2 + index[1]])
+            interface_id = getScalarInteger(varBinds[0][1])
+            if not address_family or interface_id is None or getScalarInteger(varBinds[1][1]) == address_type_broadcast:
                 continue
+            # ipAddressPrefix points to the ipAddressPrefixTable row, the prefix length is its last sub-identifier
+            prefix = str(varBinds[2][1]).split('.')
+            prefix_length = int(prefix[-1]) if len(prefix) > 2 else {'ipv4': 32, 'ipv6': 128}[address_family]
+            interface = interfaces_ip.setdefault(local_interfaces.get(interface_id, str(interface_id)), {})
+            interface.setdefault(address_family, {})[address] = {'prefix_length': prefix_length}
+        if varBindTable:
+            return interfaces_ip
 
-            if snmp_auth and snmp_priv:
-                SNMPAuth = UsmUserData(snmp_username, snmp_password, authProtocol = auth_protocol, privProtocol = priv_protocol)
-            elif snmp_auth:
-                SNMPAuth = UsmUserData(snmp_username, snmp_password, authProtocol = auth_protocol)
-            else:
-                logging.warning('skipping host "{}" because snmp_priv requires snmp_auth'.format(host.vars['ansible_host']))
+        # ipAddrTable is indexed by the IPv4 address
+        errorIndication, errorStatus, errorIndex, varBindTable = await session.walk(*address_legacy_columns)
+        if errorIndication or errorStatus or errorIndex:
+            logger.debug('error quering SNMP host "{}" for ipAddrTable'.format(session.host))
+            return {}
+        for varBinds in varBindTable:
+            address = str(ipaddress.IPv4Address(bytes(getIndex(varBinds[0][0], ipAdEntIfIndex))))
+            interface_id = int(varBinds[0][1])
+            prefix_length = ipaddress.IPv4Network('0.0.0.0/{}'.format(varBinds[1][1].prettyPrint())).prefixlen
+            interface = interfaces_ip.setdefault(local_interfaces.get(interface_id, str(interface_id)), {})
+            interface.setdefault('ipv4', {})[address] = {'prefix_length': prefix_length}
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for interface addresses'.format(session.host), exc_info = False)
+        return {}
+
+    return interfaces_ip
+
+async def getVLANMACAddressTable(session, local_interfaces, vlan):
+    mac_address_table = []
+    context = getVLANContext(session.auth, vlan)
+    try:
+        ports, entries = await asyncio.gather(session.walk(dot1dBasePortIfIndex, context = context), session.walk(*fdb_columns, context = context))
+        for errorIndication, errorStatus, errorIndex, varBindTable in [ports, entries]:
+            if errorIndication or errorStatus or errorIndex:
+                logger.debug('error quering SNMP host "{}" for BRIDGE-MIB on VLAN {}'.format(session.host, vlan))
+                return []
+        # Bridge port to ifIndex
+        bridge_ports = {int(str(varBinds[0][0]).split('.')[-1]): int(varBinds[0][1]) for varBinds in ports[3]}
+        # dot1dTpFdbTable is indexed by the MAC address
+        for varBinds in entries[3]:
+            status = getScalarInteger(varBinds[1][1])
+            if status not in [fdb_status_learned, fdb_status_mgmt]:
                 continue
-        else:
-            logging.warning('skipping host "{}" because snmp_version "{}" is not supported'.format(host.vars['ansible_host'], host.vars['snmp_version']))
-            continue
+            interface_id = bridge_ports.get(getScalarInteger(varBinds[0][1]))
+            mac_address_table.append({
+                'mac': ':'.join('{:02X}'.format(octet) for octet in getIndex(varBinds[0][0], dot1dTpFdbPort)),
+                'interface': local_interfaces.get(interface_id, str(interface_id)) if interface_id is not None else '',
+                'vlan': vlan,
+                'static': status == fdb_status_mgmt,
+                'active': True,
+                'moves': -1,
+                'last_move': -1.0
+            })
+    except Exception as err:
+        logger.debug('cannot query SNMP host "{}" for BRIDGE-MIB on VLAN {}'.format(session.host, vlan), exc_info = False)
+        return []
+
+    return mac_address_table
+
+async def getMACAddressTable(session, local_interfaces, vlans):
+    # VLANs are walked concurrently, session.context_limit bounds the requests in flight
+    tables = await asyncio.gather(*[getVLANMACAddressTable(session, local_interfaces, vlan) for vlan in sorted(vlans) if vlan not in reserved_vlans])
+    return [entry for table in tables for entry in table]
+
+async def discoverHost(session, working_dir, incremental = False, crawl = False):
+    device_info = {}
+    unchanged = []
+    logger.debug('connecting to "{}"'.format(session.host))
+    session.reset()
+    # ifIndex to ifDescr/ifName map, kept across runs and revalidated by ifTableLastChange and sysUpTime
+    cache_dir = '{}/snmp_cache'.format(os.path.dirname(working_dir))
+    cache = readDeviceInfo(cache_dir, session.host)
+    interfaces_cached = False
+    if incremental:
+        # sysName locates the previous state, the markers tell which tables changed since then
+        await session.measure('markers', session.collect(marker_plan))
+        if session.dead:
+            logger.error('skipping not respondig host "{}"'.format(session.host))
+            return None, []
+        facts, markers = await asyncio.gather(session.measure('facts', getFacts(session)), session.measure('markers', getMarkers(session)))
+        interfaces_cached = isInterfaceCacheValid(cache, markers)
+        if facts and interfaces_cached:
+            device_path = '{}/{}'.format(working_dir, facts['hostname'].lower())
+            state = readDeviceInfo(device_path, 'snmp_state')
+            unchanged = getUnchangedTables(state, markers)
+            if unchanged:
+                logger.debug('SNMP host "{}": reusing unchanged {}'.format(session.host, ', '.join(unchanged)))
+        plan = CollectionPlan()
+        if not interfaces_cached:
+            plan.extend(interface_plan)
+        if 'cdp_neighbors' not in unchanged:
+            plan.addTable(*cdp_columns)
+        if 'lldp_neighbors' not in unchanged:
+            plan.addTable(*lldp_loc_columns)
+            plan.addTable(*lldp_rem_columns)
+            plan.addTable(lldpRemManAddrIfSubtype)
+        plan.addTable(vtpVlanName)
+        plan.addTable(*arp_columns)
+        plan.addTable(*address_columns)
+    elif cache and cache.get('ifTableLastChange') is not None:
+        plan = cached_discovery_plan
+    else:
+        plan = discovery_plan
+    await session.measure('collect', session.collect(plan))
+    if session.dead:
+        logger.error('skipping not respondig host "{}"'.format(session.host))
+        return None, []
+
+    facts, vlans, markers = await asyncio.gather(
+        session.measure('facts', getFacts(session)),
+        session.measure('vlans', getVLANs(session)),
+        session.measure('markers', getMarkers(session))
+    )
+    if plan is cached_discovery_plan:
+        interfaces_cached = isInterfaceCacheValid(cache, markers)
+        if not interfaces_cached:
+            logger.debug('SNMP host "{}": interface table changed, walking it again'.format(session.host))
+            await session.measure('collect', session.collect(interface_plan))
+    if interfaces_cached:
+        logger.debug('SNMP host "{}": reusing cached interfaces'.format(session.host))
+        local_interfaces = {int(interface_id): name for interface_id, name in cache['interfaces'].items()}
+        interface_names = {int(interface_id): name for interface_id, name in cache.get('interface_names', {}).items()}
+    else:
+        local_interfaces, interface_names = await asyncio.gather(
+            session.measure('interfaces', getInterfaces(session)),
+            session.measure('interfaces', getInterfaceNames(session))
+        )
+        if local_interfaces and markers:
+            writeDeviceInfo({session.host: {
+                'sysUpTime': markers.get('sysUpTime'),
+                'ifTableLastChange': markers.get('ifTableLastChange'),
+                'interfaces': local_interfaces,
+                'interface_names': interface_names
+            }}, cache_dir)
+    # CDP and LLDP neighbors are indexed by ifIndex/port, so they wait for the interface list
+    if 'cdp_neighbors' in unchanged:
+        cdp_neighbors = readDeviceInfo(device_path, 'cdp_neighbors') or {}
+    else:
+        cdp_neighbors = await session.measure('cdp_neighbors', getCDPNeighbors(session, local_interfaces))
+    if 'lldp_neighbors' in unchanged:
+        lldp_neighbors = readDeviceInfo(device_path, 'lldp_neighbors') or {}
+    else:
+        lldp_neighbors = await session.measure('lldp_neighbors', getLLDPNeighbors(session, local_interfaces, interface_names))
+    arp_table, interfaces_ip, mac_address_table = await asyncio.gather(
+        session.measure('arp_table', getARPTable(session, local_interfaces, markers.get('sysUpTime'))),
+        session.measure('interfaces_ip', getInterfacesIP(session, local_interfaces)),
+        session.measure('mac_address_table', getMACAddressTable(session, local_interfaces, vlans))
+    )
+
+    if facts and local_interfaces:
+        device_info['facts'] = facts
+        for interface_id, interface_name in local_interfaces.items():
+            if interface_name not in ignore_snmp_interfaces:
+                device_info['facts']['interface_list'].append(interface_name)
+    else:
+        logger.error('skipping not respondig host "{}"'.format(session.host))
+        return None, []
+    if cdp_neighbors:
+        device_info['cdp_neighbors'] = cdp_neighbors
+    if lldp_neighbors:
+        device_info['lldp_neighbors'] = lldp_neighbors
+    if vlans:
+        device_info['vlans'] = vlans
+    if arp_table:
+        device_info['arp_table'] = arp_table
+    if interfaces_ip:
+        device_info['interfaces_ip'] = interfaces_ip
+    if mac_address_table:
+        device_info['mac_address_table'] = mac_address_table
+    device_info['snmp_state'] = {
+        'markers': markers
+    }
+
+    # Addresses of the neighbors, to be crawled
+    neighbor_addresses = []
+    if crawl:
+        for neighbors in list(cdp_neighbors.values()) + list(lldp_neighbors.values()):
+            for neighbor in neighbors:
+                if neighbor.get('remote_management_address'):
+                    neighbor_addresses.append(neighbor['remote_management_address'])
+
+    return device_info, neighbor_addresses
 
-        logger.debug('connecting to "{}"'.format(host.vars['ansible_host']))
-        facts = getFacts(host.vars['ansible_host'], SNMPAuth)
-        local_interfaces = getInterfaces(host.vars['ansible_host'], SNMPAuth)
-        cdp_neighbors = getCDPNeighbors(host.vars['ansible_host'], SNMPAuth, local_interfaces)
-        vlans = getVLANs(host.vars['ansible_host'], SNMPAuth)
-
-        if facts and local_interfaces:
-            device_info['facts'] = facts
-            for interface_id, interface_name in local_interfaces.items():
-                if interface_name not in ignore_snmp_interfaces:
-                    device_info['facts']['interface_list'].append(interface_name)
-        else:
-            logger.error('skipping not respondig host "{}"'.format(host.vars['ansible_host']))
+def isCrawlable(address, options):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    if options['include'] and not any(address in network for network in options['include']):
+        return False
+    return not any(address in network for network in options['exclude'])
+
+async def pollHost(session, depth, working_dir, options, discovered, addNeighbor):
+    started = time.time()
+    result = {'status': 'failed', 'depth': depth}
+    try:
+        device_info, neighbor_addresses = await discoverHost(session, working_dir, options['incremental'], depth < options['depth'])
+        if device_info:
+            hostname = device_info['facts']['hostname'].lower()
+            result['hostname'] = hostname
+            # The same device can be reached through more than one management address
+            if discovered.setdefault(hostname, session.host) != session.host:
+                logger.debug('skipping "{}", already discovered as "{}"'.format(session.host, hostname))
+                result['status'] = 'duplicate'
+            else:
+                writeDeviceInfo(device_info, '{}/{}'.format(working_dir, hostname), options['ndjson'])
+                result['status'] = 'discovered'
+                for address in neighbor_addresses:
+                    addNeighbor(address, depth + 1, session)
+    except Exception as err:
+        logger.error('cannot discover host "{}"'.format(session.host), exc_info = True)
+    result['elapsed'] = round(time.time() - started, 3)
+    result['health'] = session.getHealth()
+    result['metrics'] = session.getMetrics()
+    return result
+
+async def discoverWorker(queue, working_dir, options, discovered, addNeighbor, results):
+    while True:
+        session, depth = await queue.get()
+        try:
+            results[session.host] = await pollHost(session, depth, working_dir, options, discovered, addNeighbor)
+        finally:
+            queue.task_done()
+
+async def discover(jobs, working_dir, options, known = (), depths = None, worker = None):
+    # depths: crawl depth of jobs that are neighbors found in a previous round (see main())
+    snmp_engines = SNMPEngines()
+    health = loadHostHealth(getHealthFile(working_dir))
+    queue = asyncio.Queue()
+    sessions = []
+    host_vars_by_host = {}
+    discovered = {}
+    results = {}
+    deferred = {}
+    global_limit = TokenBucket(options['max_pps']) if options.get('max_pps') else None
+
+    def newSession(host, SNMPAuth, host_vars):
+        host_vars_by_host[host] = host_vars
+        session = newHostSession(snmp_engines, host, SNMPAuth, host_vars, options, health.get(host), global_limit)
+        sessions.append(session)
+        return session
+
+    def addNeighbor(address, depth, parent):
+        # Neighbors are polled with the credentials of the device that found them
+        # (known hosts are discovered by another worker process)
+        if address in host_vars_by_host or address in known or not isCrawlable(address, options):
+            return
+        if worker and not isOwnedBy(address, worker):
+            # Returned to the parent, which polls it in the next round unless its owner found it too
+            deferred.setdefault(parent.host, {}).setdefault(address, (depth, parent.auth, host_vars_by_host[parent.host]))
+            return
+        logger.debug('crawling neighbor "{}" found by "{}" (depth {})'.format(address, parent.host, depth))
+        queue.put_nowait((newSession(address, parent.auth, host_vars_by_host[parent.host]), depth))
+
+    for host, SNMPAuth, host_vars in jobs:
+        if host not in host_vars_by_host:
+            newSession(host, SNMPAuth, host_vars)
+    # Hosts that did not answer last time are probed last
+    for session in sorted(sessions, key = lambda session: session.failures > 0):
+        queue.put_nowait((session, (depths or {}).get(session.host, 0)))
+
+    workers = [asyncio.ensure_future(discoverWorker(queue, working_dir, options, discovered, addNeighbor, results)) for i in range(options['concurrency'])]
+    await queue.join()
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions = True)
+    snmp_engines.close()
+    for host, neighbors in deferred.items():
+        results[host]['deferred'] = [(address, ) + neighbor for address, neighbor in neighbors.items()]
+    return results
+
+def newHostSession(engines, host, SNMPAuth, host_vars, options, health, global_limit):
+    return SNMPSession(engines.get(SNMPAuth), host, SNMPAuth,
+        port = int(host_vars.get('snmp_port', 161)),
+        max_requests = int(host_vars.get('snmp_max_requests', options['host_concurrency'])),
+        max_context_requests = int(host_vars.get('snmp_max_vlan_requests', snmp_max_vlan_requests)),
+        max_pps = float(host_vars.get('snmp_max_pps', 0)),
+        global_limit = global_limit,
+        max_repetitions = int(host_vars.get('snmp_max_repetitions', snmp_max_repetitions)),
+        timeout = float(host_vars.get('snmp_timeout', snmp_timeout)),
+        retries = int(host_vars.get('snmp_retries', snmp_retries)),
+        health = health
+    )
+
+def getJobs(hosts):
+    # Address, SNMP authentication and variables of each usable host
+    jobs = []
+    for host in hosts:
+        SNMPAuth = getSNMPAuth(host)
+        if not SNMPAuth:
             continue
-        if cdp_neighbors:
-            device_info['cdp_neighbors'] = cdp_neighbors
-        if vlans:
-            device_info['vlans'] = vlans
+        jobs.append((host.vars['ansible_host'], SNMPAuth, dict(host.vars)))
+    return jobs
+
+def getGlobalRate(jobs, workers):
+    # The global rate is set as snmp_global_max_pps (e.g. in [all:vars]) and split among the worker processes
+    global_rates = [float(host_vars['snmp_global_max_pps']) for host, SNMPAuth, host_vars in jobs if host_vars.get('snmp_global_max_pps')]
+    if global_rates:
+        return min(global_rates) / max(1, min(workers, len(jobs)))
+    return None
+
+async def poll(working_dir, options):
+    # Daemon mode: engines, sessions and caches live as long as the process, each host is polled on
+    # its own interval (snmp_poll_interval or --interval), with jitter so that hosts drift apart
+    snmp_engines = SNMPEngines()
+    health = loadHostHealth(getHealthFile(working_dir))
+    status_file = getRunFile(working_dir, options, 'discovery_status.json')
+    started = time.time()
+    hosts = {}
+    schedule = []
+    queue = asyncio.Queue()
+    discovered = {}
+    results = {}
+    counters = {'polls': 0, 'polling': 0, 'inventory_loaded': None}
+    global_limit = None
+    stop = asyncio.Event()
+
+    def scheduleHost(address, due):
+        hosts[address]['due'] = due
+        heapq.heappush(schedule, (due, address))
+
+    def addHost(address, SNMPAuth, host_vars, depth):
+        interval = float(host_vars.get('snmp_poll_interval', options['interval']))
+        hosts[address] = {
+            'session': newHostSession(snmp_engines, address, SNMPAuth, host_vars, options, health.get(address), global_limit),
+            'host_vars': host_vars,
+            'depth': depth,
+            'interval': interval,
+            'queued': False
+        }
+        # The first polls are spread over one interval
+        scheduleHost(address, time.time() + random.uniform(0, interval))
+
+    def addNeighbor(address, depth, parent):
+        if address in hosts or not isCrawlable(address, options):
+            return
+        logger.debug('crawling neighbor "{}" found by "{}" (depth {})'.format(address, parent.host, depth))
+        addHost(address, parent.auth, hosts[parent.host]['host_vars'], depth)
+
+    def loadHosts():
+        nonlocal global_limit
+        inventory_hosts = loadInventory(options['inventory'], options)
+        if inventory_hosts is None:
+            # Keep polling the hosts already known
+            return False
+        jobs = getJobs(inventory_hosts)
+        rate = getGlobalRate(jobs, 1)
+        if rate != (global_limit.rate if global_limit else None):
+            global_limit = TokenBucket(rate) if rate else None
+            for host in hosts.values():
+                host['session'].global_limit = global_limit
+        addresses = set(address for address, SNMPAuth, host_vars in jobs)
+        removed = [address for address, host in hosts.items() if host['depth'] == 0 and address not in addresses]
+        for address in removed:
+            del hosts[address]
+            results.pop(address, None)
+            for hostname in [hostname for hostname, owner in discovered.items() if owner == address]:
+                del discovered[hostname]
+        added = 0
+        for address, SNMPAuth, host_vars in jobs:
+            # New hosts, changed variables and crawled neighbors now in the inventory get a new session
+            if address in hosts and hosts[address]['depth'] == 0 and hosts[address]['host_vars'] == host_vars:
+                continue
+            addHost(address, SNMPAuth, host_vars, 0)
+            added = added + 1
+        counters['inventory_loaded'] = time.time()
+        logger.info('inventory loaded: {} hosts, {} new or changed, {} removed'.format(len(addresses), added, len(removed)))
+        return True
+
+    async def reloadInventory(loaded_mtime):
+        while True:
+            try:
+                mtime = os.path.getmtime(options['inventory'])
+            except OSError as err:
+                mtime = loaded_mtime
+            if mtime != loaded_mtime and loadHosts():
+                loaded_mtime = mtime
+            await asyncio.sleep(poll_reload_interval)
+
+    async def scheduler():
+        while True:
+            now = time.time()
+            while schedule and schedule[0][0] <= now:
+                due, address = heapq.heappop(schedule)
+                # Entries of removed or rescheduled hosts are stale
+                if address in hosts and hosts[address]['due'] == due and not hosts[address]['queued']:
+                    hosts[address]['queued'] = True
+                    queue.put_nowait(address)
+            await asyncio.sleep(min(1.0, schedule[0][0] - now) if schedule else 1.0)
+
+    async def worker():
+        while True:
+            address = await queue.get()
+            host = hosts.get(address)
+            try:
+                if not host:
+                    continue
+                counters['polling'] = counters['polling'] + 1
+                lag = time.time() - host['due']
+                result = await pollHost(host['session'], host['depth'], working_dir, options, discovered, addNeighbor)
+                result['lag'] = round(lag, 3)
+                counters['polls'] = counters['polls'] + 1
+                if hosts.get(address) is host:
+                    results[address] = result
+                    # Next poll one interval after the previous due time, unless too late already
+                    scheduleHost(address, max(time.time(), host['due'] + host['interval'] * random.uniform(1 - poll_jitter, 1 + poll_jitter)))
+            finally:
+                if host:
+                    host['queued'] = False
+                    counters['polling'] = counters['polling'] - 1
+                queue.task_done()
+
+    def writeStatus():
+        now = time.time()
+        lags = [now - host['due'] for host in hosts.values() if host['due'] <= now]
+        status = {
+            'heartbeat': now,
+            'started': started,
+            'pid': os.getpid(),
+            'hosts': len(hosts),
+            'queue_depth': queue.qsize(),
+            'polling': counters['polling'],
+            'overdue': len(lags),
+            'max_lag': round(max(lags or [0]), 3),
+            'polls': counters['polls'],
+            'failed': len([result for result in results.values() if result['status'] == 'failed']),
+            'inventory_loaded': counters['inventory_loaded']
+        }
+        try:
+            output = open('{}.tmp'.format(status_file), 'w+')
+            output.write(json.dumps(status))
+            output.close()
+            os.replace('{}.tmp'.format(status_file), status_file)
+        except Exception as err:
+            logger.error('cannot write "{}"'.format(status_file), exc_info = True)
+        saveHostHealth(getHealthFile(working_dir), dict((address, result['health']) for address, result in results.items()))
+        saveRunMetrics(getRunFile(working_dir, options, 'run_metrics.json'),
+            dict((address, {key: value for key, value in result.items() if key not in ['health', 'metrics']}) for address, result in results.items()),
+            dict((address, result['metrics']) for address, result in results.items()),
+            started, 'snmp')
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(poll_status_interval)
+            writeStatus()
+
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, stop.set)
+    # Read before loading: a change made while loading is picked up by the next check
+    try:
+        loaded_mtime = os.path.getmtime(options['inventory'])
+    except OSError as err:
+        loaded_mtime = None
+    if not loadHosts():
+        return
+    tasks = [asyncio.ensure_future(task) for task in [reloadInventory(loaded_mtime), scheduler(), heartbeat()]]
+    tasks.extend(asyncio.ensure_future(worker()) for i in range(options['concurrency']))
+    await stop.wait()
+    logger.info('stopping, {} polls done'.format(counters['polls']))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+    writeStatus()
+    snmp_engines.close()
+
+def discoverJobs(jobs, working_dir, options, known, depths, worker = None):
+    return asyncio.run(discover(jobs, working_dir, options, known, depths, worker))
+
+def getHealthFile(working_dir):
+    return '{}/snmp_health.json'.format(os.path.dirname(working_dir))
+
+def main():
+    # Reading options
+    hosts, working_dir, options = checkOpts()
+    started = time.time()
+
+    if options['daemon']:
+        if options['workers'] > 1:
+            logger.warning('--workers is ignored with --daemon, run one daemon per --shard instead')
+        asyncio.run(poll(working_dir, options))
+        return
+
+    # Preparing SNMP authentication for each host
+    jobs = getJobs(hosts)
+    options['max_pps'] = getGlobalRate(jobs, options['workers'])
+
+    # Discover hosts concurrently, optionally splitting them across worker processes. Each crawled
+    # neighbor is polled by the worker owning its address; neighbors found by other workers only
+    # are polled in another round, until no new neighbor is found
+    known = set(host for host, SNMPAuth, host_vars in jobs)
+    depths = {}
+    results = {}
+    while jobs:
+        round_results = runWorkers(discoverJobs, jobs, options['workers'], working_dir, options, known, depths, with_worker = True)
+        results.update(round_results)
+        known.update(round_results)
+        jobs = []
+        for host, result in round_results.items():
+            for address, depth, SNMPAuth, host_vars in result.pop('deferred', []):
+                if address not in known:
+                    known.add(address)
+                    depths[address] = depth
+                    jobs.append((address, SNMPAuth, host_vars))
 
-        writeDeviceInfo(device_info, '{}/{}'.format(working_dir, device_info['facts']['hostname'].lower()))
+    # Only the parent writes shared files
+    saveHostHealth(getHealthFile(working_dir), dict((host, result.pop('health')) for host, result in results.items()))
+    metrics = dict((host, result.pop('metrics')) for host, result in results.items())
+    saveRunSummary(getRunFile(working_dir, options, 'discovery_summary.json'), results, started, options)
+    saveRunMetrics(getRunFile(working_dir, options, 'run_metrics.json'), results, metrics, started, 'snmp')
 
 if __name__ == "__main__":
     main()
@@ -4,7 +4,7 @@ __copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
 __license__ = 'https://www.gnu.org/licenses/gpl.html'
 __revision__ = '20170329'
 
-import getopt, json, logging, os, sys
+import collections.abc, concurrent.futures, contextlib, contextvars, getopt, ipaddress, json, logging, os, sys, time, zlib
 from ansible.parsing.dataloader import DataLoader
 from ansible.inventory.manager import InventoryManager
 from ansible.vars.manager import VariableManager
@@ -17,17 +17,73 @@ ignore_snmp_interfaces = [
     'VoIP-Null0'
 ]
 
+# Device tables saved as NDJSON with --ndjson: one entry per line, written and read incrementally.
+# Only the IOS MAC address table of --raw and replays is parsed while written, the other getters
+# (SNMP walks included) still build the whole table before it is written
+ndjson_keys = [
+    'arp_table',
+    'mac_address_table'
+]
+
+# Device info saved under another name by previous versions: {key: former key}. The NAPALM ARP
+# table was get_arp_table.json, it is arp_table.json as for SNMP
+former_device_info_keys = {
+    'arp_table': 'get_arp_table'
+}
+
+# Collector being measured by the running task (getters of a host may run concurrently)
+current_collector = contextvars.ContextVar('current_collector', default = 'session')
+collector_metrics = {
+    'seconds': 'Time spent in the collector',
+    'requests': 'SNMP requests sent',
+    'timeouts': 'SNMP requests not answered in time',
+    'errors': 'Failed requests, commands or getters',
+    'varbinds': 'SNMP varbinds received',
+    'rows': 'Table rows returned to the collector',
+    'commands': 'CLI commands sent',
+    'bytes': 'CLI output bytes received'
+}
+
 def usage():
     print('Usage: {} [OPTIONS]'.format(sys.argv[0]))
     print('  -i STRING  inventory file')
+    print('  -c INT     number of hosts discovered concurrently (default: 1)')
+    print('  -p INT     number of concurrent requests per host (default: 1)')
+    print('  -n         incremental: walk again only the tables changed since the last run')
+    print('  -r INT     crawl CDP/LLDP neighbors up to INT hops from the inventory hosts')
+    print('  -a CIDR    crawl only neighbors inside CIDR (allowed multiple times)')
+    print('  -x CIDR    never crawl neighbors inside CIDR (allowed multiple times)')
+    print('  --workers INT  split hosts across INT processes (default: 1)')
+    print('  --shard I/N    discover only the I-th of N slices of the inventory')
+    print('  --daemon       keep polling each host every interval, reloading the inventory when it changes')
+    print('  --interval INT seconds between polls of a host in daemon mode (default: 300)')
+    print('  --host-timeout INT  seconds a host may take, from login to the last getter (NAPALM, default: 300)')
+    print('  --raw          capture IOS command outputs first, then parse them in a process pool (NAPALM)')
+    print('  --ndjson       save ARP and MAC address tables as NDJSON, one entry per line')
     print('  -d         enable debug')
     sys.exit(1)
 
 def checkOpts():
     inventory_file = None
+    options = {
+        'concurrency': 1,
+        'host_concurrency': 1,
+        'incremental': False,
+        'depth': 0,
+        'include': [],
+        'exclude': [],
+        'workers': 1,
+        'shard': None,
+        'daemon': False,
+        'interval': 300,
+        'host_timeout': 300,
+        'raw': False,
+        'ndjson': False,
+        'inventory': None
+    }
     # Reading options
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'di:')
+        opts, args = getopt.getopt(sys.argv[1:], 'a:c:di:np:r:x:', ['daemon', 'host-timeout=', 'interval=', 'ndjson', 'raw', 'shard=', 'workers='])
     except getopt.GetoptError as err:
         logger.error('cannot parse options', exc_info = True)
         usage()
@@ -38,6 +94,32 @@ def checkOpts():
         elif opt == '-i':
             inventory_file = arg
             working_dir = '{}/working/{}/devices'.format(os.path.dirname(os.path.abspath(arg)), os.environ.get('NETDOC_FOLDER', 'default'))
+        elif opt == '-c':
+            options['concurrency'] = checkPositiveInt(opt, arg)
+        elif opt == '-p':
+            options['host_concurrency'] = checkPositiveInt(opt, arg)
+        elif opt == '-n':
+            options['incremental'] = True
+        elif opt == '-r':
+            options['depth'] = checkPositiveInt(opt, arg)
+        elif opt == '-a':
+            options['include'].append(checkNetwork(opt, arg))
+        elif opt == '-x':
+            options['exclude'].append(checkNetwork(opt, arg))
+        elif opt == '--workers':
+            options['workers'] = checkPositiveInt(opt, arg)
+        elif opt == '--shard':
+            options['shard'] = checkShard(opt, arg)
+        elif opt == '--daemon':
+            options['daemon'] = True
+        elif opt == '--interval':
+            options['interval'] = checkPositiveInt(opt, arg)
+        elif opt == '--host-timeout':
+            options['host_timeout'] = checkPositiveInt(opt, arg)
+        elif opt == '--raw':
+            options['raw'] = True
+        elif opt == '--ndjson':
+            options['ndjson'] = True
         else:
             logger.error('unhandled option ({})'.format(opt))
             usage()
@@ -52,24 +134,270 @@ def checkOpts():
         sys.exit(1)
 
     # Loading Ansible inventory
+    options['inventory'] = inventory_file
+    hosts = loadInventory(inventory_file, options)
+    if hosts is None:
+        sys.exit(1)
+    return hosts, working_dir, options
+
+def loadInventory(inventory_file, options):
     ansible_loader = DataLoader()
     try:
         ansible_inventory = InventoryManager(loader = ansible_loader, sources = inventory_file)
     except Exception as err:
         logger.error('cannot read inventory file "{}"'.format(inventory_file), exc_info = True)
+        return None
     variable_manager = VariableManager(loader = ansible_loader, inventory = ansible_inventory)
-    return ansible_inventory.get_hosts(), working_dir
+    hosts = ansible_inventory.get_hosts()
+    if options['shard']:
+        hosts = shardHosts(hosts, *options['shard'])
+    return hosts
 
-def writeDeviceInfo(device_info, path):
+def checkPositiveInt(opt, arg):
+    try:
+        value = int(arg)
+    except ValueError:
+        value = 0
+    if value < 1:
+        logger.error('option {} requires a positive integer ("{}" given)'.format(opt, arg))
+        usage()
+    return value
+
+def writeDeviceInfo(device_info, path, ndjson = False):
+    # Iterators (e.g. getters yielding entries) are always written as NDJSON. Empty tables are not
+    # written in either format, as SNMP getters return them when a walk fails
     for key, value in device_info.items():
+        if key in ndjson_keys and not isinstance(value, collections.abc.Iterator) and not value:
+            continue
         try:
             os.makedirs(path, exist_ok = True)
         except Exception as err:
             logger.error('cannot create directory "{}"'.format(path), exc_info = True)
+        if isinstance(value, collections.abc.Iterator) or (ndjson and key in ndjson_keys):
+            try:
+                if writeDeviceTable(value, path, key) and key in former_device_info_keys:
+                    removeFile('{}/{}.json'.format(path, former_device_info_keys[key]))
+            except Exception as err:
+                logger.error('cannot write "{}/{}.ndjson"'.format(path, key), exc_info = True)
+            continue
         try:
             output = open('{}/{}.json'.format(path, key), 'w+')
             output.write(json.dumps(value))
             output.close()
+            removeFile('{}/{}.ndjson'.format(path, key))
+            if key in former_device_info_keys:
+                removeFile('{}/{}.json'.format(path, former_device_info_keys[key]))
         except Exception as err:
             logger.error('cannot write "{}/{}.json"'.format(path, key), exc_info = True)
     return True
+
+def writeDeviceTable(entries, path, key):
+    # Entries are written as they come, written aside and renamed so readers never see a partial
+    # table. Exceptions raised by entries (e.g. a parser) are raised here. As in writeDeviceInfo(),
+    # an empty table is not written
+    table_file = '{}/{}.ndjson'.format(path, key)
+    written = 0
+    try:
+        with open('{}.tmp'.format(table_file), 'w+') as output:
+            for entry in entries:
+                output.write(json.dumps(entry))
+                output.write('\n')
+                written += 1
+        if not written:
+            removeFile('{}.tmp'.format(table_file))
+            return None
+        os.replace('{}.tmp'.format(table_file), table_file)
+    except Exception as err:
+        removeFile('{}.tmp'.format(table_file))
+        raise
+    # Saved as JSON by a previous run
+    removeFile('{}/{}.json'.format(path, key))
+    return table_file
+
+def removeFile(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def checkNetwork(opt, arg):
+    try:
+        return ipaddress.ip_network(arg, strict = False)
+    except ValueError:
+        logger.error('option {} requires a network in CIDR notation ("{}" given)'.format(opt, arg))
+        usage()
+
+def readDeviceInfo(path, key):
+    # The whole value, an NDJSON table is loaded as a list: use iterDeviceInfo() to stream it
+    try:
+        return json.load(open('{}/{}.json'.format(path, key)))
+    except FileNotFoundError:
+        if os.path.isfile('{}/{}.ndjson'.format(path, key)):
+            return list(iterDeviceInfo(path, key))
+        if key in former_device_info_keys:
+            # Saved by a previous version
+            return readDeviceInfo(path, former_device_info_keys[key])
+        return None
+    except Exception as err:
+        logger.warning('cannot read "{}/{}.json"'.format(path, key), exc_info = True)
+        return None
+
+def iterDeviceInfo(path, key):
+    # Entries of a table one at a time: NDJSON is read line by line, a JSON list is loaded first
+    try:
+        table = open('{}/{}.ndjson'.format(path, key))
+    except FileNotFoundError:
+        yield from readDeviceInfo(path, key) or []
+        return
+    with table:
+        for line in table:
+            if line.strip():
+                yield json.loads(line)
+
+def checkShard(opt, arg):
+    try:
+        shard, shards = [int(value) for value in arg.split('/')]
+    except ValueError:
+        shard, shards = 0, 0
+    if shards < 1 or shard < 1 or shard > shards:
+        logger.error('option {} requires I/N with 1 <= I <= N ("{}" given)'.format(opt, arg))
+        usage()
+    return shard, shards
+
+def shardHosts(hosts, shard, shards):
+    # A stable hash keeps each host in the same shard across runs and invocations
+    return [host for host in hosts if zlib.crc32(host.name.encode()) % shards == shard - 1]
+
+def runWorkers(target, jobs, workers, *args, with_worker = False):
+    # Each process runs target(jobs slice, *args) and returns a dict of per-host results. With
+    # with_worker, target also gets worker = (I, N): it runs in the I-th of N processes
+    workers = min(workers, len(jobs))
+    if workers < 2:
+        return target(jobs, *args, worker = (1, 1)) if with_worker else target(jobs, *args)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = logger.setLevel, initargs = (logger.level,)) as pool:
+        futures = [pool.submit(target, jobs[i::workers], *args, **({'worker': (i + 1, workers)} if with_worker else {})) for i in range(workers)]
+        for future in futures:
+            try:
+                results.update(future.result())
+            except Exception as err:
+                logger.error('worker process failed', exc_info = True)
+    return results
+
+def isOwnedBy(address, worker):
+    # Same stable hash as shardHosts(): addresses found by more than one worker have a single owner
+    return zlib.crc32(address.encode()) % worker[1] == worker[0] - 1
+
+def saveRunSummary(path, results, started, options):
+    hostnames = [result['hostname'] for result in results.values() if result.get('hostname')]
+    summary = {
+        'started': started,
+        'elapsed': round(time.time() - started, 3),
+        'workers': options['workers'],
+        'shard': '{}/{}'.format(*options['shard']) if options['shard'] else None,
+        'hosts': len(results),
+        'discovered': len([result for result in results.values() if result['status'] == 'discovered']),
+        'duplicates': len([result for result in results.values() if result['status'] == 'duplicate']),
+        'failed': len([result for result in results.values() if result['status'] == 'failed']),
+        'devices': len(set(hostnames))
+    }
+    logger.info('discovered {devices} devices from {hosts} hosts ({failed} failed) in {elapsed}s'.format(**summary))
+    if summary['failed']:
+        logger.warning('{} hosts failed, see "{}"'.format(summary['failed'], path))
+    try:
+        output = open(path, 'w+')
+        output.write(json.dumps({'summary': summary, 'hosts': results}))
+        output.close()
+    except Exception as err:
+        logger.error('cannot write "{}"'.format(path), exc_info = True)
+    return summary
+
+def getRunFile(working_dir, options, filename):
+    # Separate --shard invocations must not overwrite each other
+    if options['shard']:
+        name, extension = os.path.splitext(filename)
+        filename = '{}_{}of{}{}'.format(name, options['shard'][0], options['shard'][1], extension)
+    return '{}/{}'.format(os.path.dirname(working_dir), filename)
+
+class CollectorMetrics:
+    # Counters of a host, grouped by collector (getter or table)
+    def __init__(self):
+        self.collectors = {}
+
+    def count(self, metric, value = 1, collector = None):
+        counters = self.collectors.setdefault(collector or current_collector.get(), {})
+        counters[metric] = counters.get(metric, 0) + value
+
+    @contextlib.contextmanager
+    def measure(self, collector):
+        token = current_collector.set(collector)
+        started = time.monotonic()
+        try:
+            yield self
+        except Exception as err:
+            self.count('errors', collector = collector)
+            raise
+        finally:
+            self.count('seconds', time.monotonic() - started, collector = collector)
+            current_collector.reset(token)
+
+    def getMetrics(self):
+        # Copied first: a host abandoned after its timeout may still be counting
+        return {collector: {metric: round(value, 6) for metric, value in list(counters.items())} for collector, counters in list(self.collectors.items())}
+
+def getPrometheusLabels(labels):
+    values = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        values.append('{}="{}"'.format(name, value))
+    return '{{{}}}'.format(','.join(values))
+
+def saveRunMetrics(path, results, metrics, started, method):
+    # JSON for later analysis, plus the Prometheus text format (node_exporter textfile collector)
+    run_metrics = {
+        'method': method,
+        'started': started,
+        'elapsed': round(time.time() - started, 3),
+        'hosts': {}
+    }
+    families = {}
+
+    def addSample(name, description, labels, value):
+        families.setdefault(name, (description, []))
+        families[name][1].append('{}{} {}'.format(name, getPrometheusLabels(labels), value))
+
+    for host, result in sorted(results.items()):
+        host_metrics = dict(metrics.get(host, {}))
+        host_metrics.update({'status': result['status'], 'hostname': result.get('hostname'), 'elapsed': result['elapsed']})
+        run_metrics['hosts'][host] = host_metrics
+        labels = {'method': method, 'host': host, 'hostname': result.get('hostname') or ''}
+        addSample('netdoc_discovery_host_up', 'Whether the host has been discovered', labels, int(result['status'] != 'failed'))
+        addSample('netdoc_discovery_host_seconds', 'Time spent discovering the host', labels, result['elapsed'])
+        for metric in ['bytes_sent', 'bytes_received']:
+            if metric in host_metrics:
+                addSample('netdoc_discovery_host_{}'.format(metric), 'Bytes {} on the wire'.format(metric.split('_')[1]), labels, host_metrics[metric])
+        for collector, counters in sorted(host_metrics.get('collectors', {}).items()):
+            for metric, value in sorted(counters.items()):
+                addSample('netdoc_discovery_collector_{}'.format(metric), collector_metrics.get(metric, metric), dict(labels, collector = collector), value)
+    addSample('netdoc_discovery_last_run_timestamp_seconds', 'Start time of the last discovery run', {'method': method}, started)
+    addSample('netdoc_discovery_last_run_seconds', 'Duration of the last discovery run', {'method': method}, run_metrics['elapsed'])
+
+    try:
+        output = open(path, 'w+')
+        output.write(json.dumps(run_metrics))
+        output.close()
+    except Exception as err:
+        logger.error('cannot write "{}"'.format(path), exc_info = True)
+    prometheus_path = '{}.prom'.format(os.path.splitext(path)[0])
+    try:
+        # Written aside and renamed, so the textfile collector never reads a partial file
+        output = open('{}.tmp'.format(prometheus_path), 'w+')
+        for name, (description, samples) in families.items():
+            output.write('# HELP {} {}\n'.format(name, description))
+            output.write('# TYPE {} gauge\n'.format(name))
+            output.write('\n'.join(samples) + '\n')
+        output.close()
+        os.replace('{}.tmp'.format(prometheus_path), prometheus_path)
+    except Exception as err:
+        logger.error('cannot write "{}"'.format(prometheus_path), exc_info = True)
+    return run_metrics
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+__author__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__license__ = 'https://www.gnu.org/licenses/gpl.html'
+__revision__ = '20170329'
+
+import concurrent.futures
+from functions import *
+from discovery_with_napalm import logFailures, parseOutputs
+
+def usage():
+    print('Usage: {} [OPTIONS] DIR...'.format(sys.argv[0]))
+    print('  Parse IOS outputs saved in each DIR (devices/<host> of the Ansible roles, napalm_raw/<host> of --raw)')
+    print('  -o STRING  output directory (default: working/$NETDOC_FOLDER/devices)')
+    print('  -w INT     number of parse processes (default: CPU count)')
+    print('  --ndjson   save MAC address tables as NDJSON, written while parsed')
+    print('  -d         enable debug')
+    sys.exit(1)
+
+def replayDirs(output_dirs, working_dir, processes, ndjson):
+    # Saved outputs need no device access, directories are parsed by all the processes at once
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers = processes, initializer = logger.setLevel, initargs = (logger.level,)) as pool:
+        futures = dict((path, pool.submit(parseOutputs, os.path.basename(path), path, working_dir, ndjson)) for path in output_dirs)
+        for path, future in futures.items():
+            try:
+                hostname, errors, collectors = future.result()
+            except Exception as err:
+                logger.error('cannot parse outputs in "{}"'.format(path), exc_info = True)
+                hostname, errors, collectors = None, {'parse': str(err) or type(err).__name__}, {}
+            result = {'status': 'discovered' if hostname else 'failed'}
+            if hostname:
+                result['hostname'] = hostname
+            if errors:
+                result['errors'] = errors
+            result['elapsed'] = round(sum(counters.get('seconds', 0) for counters in collectors.values()), 3)
+            result['metrics'] = {'collectors': collectors}
+            results[path] = result
+    return results
+
+def main():
+    working_dir = '{}/working/{}/devices'.format(os.getcwd(), os.environ.get('NETDOC_FOLDER', 'default'))
+    processes = os.cpu_count() or 1
+    ndjson = False
+    # Reading options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'dho:w:', ['ndjson'])
+    except getopt.GetoptError as err:
+        logger.error('cannot parse options', exc_info = True)
+        usage()
+    for opt, arg in opts:
+        if opt == '-d':
+            logger.setLevel(logging.DEBUG)
+        elif opt == '-o':
+            working_dir = os.path.abspath(arg)
+        elif opt == '-w':
+            processes = checkPositiveInt(opt, arg)
+        elif opt == '--ndjson':
+            ndjson = True
+        else:
+            usage()
+
+    # Checking directories
+    output_dirs = [os.path.abspath(path).rstrip('/') for path in args if os.path.isdir(path)]
+    for path in args:
+        if not os.path.isdir(path):
+            logger.warning('skipping "{}", not a directory'.format(path))
+    if not output_dirs:
+        logger.error('no output directory specified')
+        usage()
+
+    started = time.time()
+    results = replayDirs(output_dirs, working_dir, processes, ndjson)
+    metrics = dict((path, result.pop('metrics')) for path, result in results.items())
+    logFailures(results)
+    options = {'workers': processes, 'shard': None}
+    saveRunSummary(getRunFile(working_dir, options, 'replay_summary.json'), results, started, options)
+    saveRunMetrics(getRunFile(working_dir, options, 'replay_metrics.json'), results, metrics, started, 'replay')
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+__author__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__copyright__ = 'Andrea Dainese <andrea.dainese@gmail.com>'
+__license__ = 'https://www.gnu.org/licenses/gpl.html'
+__revision__ = '20170329'
+
+import asyncio, time
+from pysnmp.carrier.asyncio.dispatch import AsyncioDispatcher
+from pysnmp.hlapi.asyncio import *
+from pysnmp.proto.errind import RequestTimedOut
+from pysnmp.proto.rfc1902 import ObjectName
+from pysnmp.proto.rfc1905 import EndOfMibView, noSuchObject
+from functions import *
+
+# Authentication objects shared by hosts with the same credentials
+snmp_auths = {}
+
+# Rows requested by each GETBULK (overridden by the snmp_max_repetitions inventory variable)
+snmp_max_repetitions = 25
+
+# Timeouts in seconds: snmp_timeout is used until the RTT of a host is known, then each request waits
+# SRTT + 4 * RTTVAR (RFC 6298) within the min/max bounds (overridden by snmp_timeout/snmp_retries)
+snmp_timeout = 1.0
+snmp_min_timeout = 0.2
+snmp_max_timeout = 5.0
+snmp_retries = 2
+# Hosts that did not answer during the previous run are probed once, with this timeout
+snmp_dead_timeout = 0.5
+
+def getSNMPAuth(host):
+    snmp_version = host.vars['snmp_version'] if 'snmp_version' in host.vars else None
+    snmp_community = host.vars['snmp_community'] if 'snmp_community' in host.vars else None
+    snmp_auth = host.vars['snmp_auth'] if 'snmp_auth' in host.vars else None
+    snmp_username = host.vars['snmp_username'] if 'snmp_username' in host.vars else None
+    snmp_password = host.vars['snmp_password'] if 'snmp_password' in host.vars else None
+    snmp_priv = host.vars['snmp_priv'] if 'snmp_priv' in host.vars else None
+    snmp_privpassword = host.vars['snmp_privpassword'] if 'snmp_privpassword' in host.vars else None
+
+    if not snmp_version:
+        logging.warning('skipping host "{}" because snmp_version is not set'.format(host.vars['ansible_host']))
+        return None
+
+    if str(snmp_version) in ['1', '2c']:
+        if not snmp_community:
+            logging.warning('skipping host "{}" because snmp_community is not set'.format(host.vars['ansible_host']), exc_info = False)
+            return None
+        key = (str(snmp_version), snmp_community)
+        if key not in snmp_auths:
+            snmp_auths[key] = CommunityData(snmp_community, mpModel = 0 if str(snmp_version) == '1' else 1)
+        return snmp_auths[key]
+    elif str(snmp_version) == '3':
+        if not snmp_auth:
+            auth_protocol = usmNoAuthProtocol
+        elif snmp_auth == 'sha' and snmp_username and snmp_password:
+            auth_protocol = usmHMACSHAAuthProtocol
+        elif snmp_auth == 'md5' and snmp_username and snmp_password:
+            auth_protocol = usmHMACMD5AuthProtocol
+        else:
+            logging.warning('skipping host "{}" because snmp_auth, snmp_username or snmp_password are not set/not valid'.format(host.vars['ansible_host']))
+            return None
+        if not snmp_priv:
+            priv_protocol = usmNoPrivProtocol
+        elif snmp_priv == 'des' and snmp_privpassword:
+            priv_protocol = usmDESPrivProtocol
+        elif snmp_priv == '3des' and snmp_privpassword:
+            priv_protocol = usm3DESEDEPrivProtocol
+        elif snmp_priv == 'aes128' and snmp_privpassword:
+            priv_protocol = usmAesCfb128Protocol
+        elif snmp_priv == 'aes192' and snmp_privpassword:
+            priv_protocol = usmAesCfb192Protocol
+        elif snmp_priv == 'aes256' and snmp_privpassword:
+            priv_protocol = usmAesCfb256Protocol
+        else:
+            logging.warning('skipping host "{}" because snmp_priv or snmp_privpassword are not set/not valid'.format(host.vars['ansible_host']))
+            return None
+
+        key = ('3', snmp_username, snmp_password, snmp_auth, snmp_privpassword, snmp_priv)
+        if key in snmp_auths:
+            return snmp_auths[key]
+        if snmp_auth and snmp_priv:
+            snmp_auths[key] = UsmUserData(snmp_username, snmp_password, snmp_privpassword, authProtocol = auth_protocol, privProtocol = priv_protocol)
+        elif snmp_auth:
+            snmp_auths[key] = UsmUserData(snmp_username, snmp_password, authProtocol = auth_protocol)
+        else:
+            logging.warning('skipping host "{}" because snmp_priv requires snmp_auth'.format(host.vars['ansible_host']))
+            return None
+        return snmp_auths[key]
+    else:
+        logging.warning('skipping host "{}" because snmp_version "{}" is not supported'.format(host.vars['ansible_host'], host.vars['snmp_version']))
+        return None
+
+def getVLANContext(auth, vlan):
+    # Cisco keeps a BRIDGE-MIB instance per VLAN: community@vlan on SNMPv1/v2c, context vlan-<id> on SNMPv3
+    if isinstance(auth, CommunityData):
+        key = (auth.mpModel, auth.communityName, vlan)
+        if key not in snmp_auths:
+            snmp_auths[key] = CommunityData('{}@{}'.format(auth.communityName, vlan), mpModel = auth.mpModel)
+        return snmp_auths[key], ContextData()
+    return auth, ContextData(contextName = 'vlan-{}'.format(vlan))
+
+class CollectionPlan:
+    # Scalars and tables needed by a run, fetched together by SNMPSession.collect()
+    def __init__(self):
+        self.scalars = []
+        self.tables = []
+        self.max_rows = {}
+
+    def addScalar(self, oid):
+        self.scalars.append(oid)
+
+    def addTable(self, *columns, max_rows = None):
+        # max_rows: only the first rows are needed, the walk stops there
+        self.tables.append(columns)
+        if max_rows:
+            self.max_rows[columns] = max_rows
+
+    def extend(self, plan):
+        self.scalars.extend(plan.scalars)
+        self.tables.extend(plan.tables)
+        self.max_rows.update(plan.max_rows)
+
+class TokenBucket:
+    # Paces packets at rate per second: each caller reserves the next slot and sleeps until it,
+    # so waiting callers are served in arrival order
+    def __init__(self, rate, burst = 1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens = self.tokens - 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+class SNMPDispatcher(AsyncioDispatcher):
+    # Counts the bytes exchanged with each agent (address, port)
+    def __init__(self, *args, **kwargs):
+        AsyncioDispatcher.__init__(self, *args, **kwargs)
+        self.bytes_sent = {}
+        self.bytes_received = {}
+
+    def sendMessage(self, outgoingMessage, transportDomain, transportAddress):
+        address = tuple(transportAddress)[:2]
+        self.bytes_sent[address] = self.bytes_sent.get(address, 0) + len(outgoingMessage)
+        return AsyncioDispatcher.sendMessage(self, outgoingMessage, transportDomain, transportAddress)
+
+    def _cbFun(self, incomingTransport, transportAddress, incomingMessage):
+        address = tuple(transportAddress)[:2]
+        self.bytes_received[address] = self.bytes_received.get(address, 0) + len(incomingMessage)
+        return AsyncioDispatcher._cbFun(self, incomingTransport, transportAddress, incomingMessage)
+
+class SNMPSession:
+    # One transport and authentication per host; the engine is shared by the sessions with the same
+    # credentials (see SNMPEngines), so SNMPv3 engine-ID discovery and time synchronization are done
+    # once per host and per run
+    def __init__(self, engine, host, auth, port = 161, max_requests = 1, max_context_requests = None, max_repetitions = snmp_max_repetitions, timeout = snmp_timeout, retries = snmp_retries, health = None, max_pps = None, global_limit = None):
+        self.engine = engine
+        self.host = host
+        self.auth = auth
+        self.max_repetitions = max_repetitions
+        self.max_varbinds = None
+        # pysnmp retries are disabled, requests are retried by request() with an adaptive timeout
+        self.transport = UdpTransportTarget((host, port), timeout = timeout, retries = 0)
+        self.context = ContextData()
+        self.limit = asyncio.Semaphore(max_requests)
+        # Walks in other contexts (e.g. per-VLAN) have their own limit, they are fanned out together
+        self.context_limit = asyncio.Semaphore(max_context_requests or max_requests)
+        # Packets per second towards this host, and towards all hosts (shared TokenBucket)
+        self.pps_limit = TokenBucket(max_pps) if max_pps else None
+        self.global_limit = global_limit
+        self.metrics = CollectorMetrics()
+        self.configured_timeout = timeout
+        self.max_retries = retries
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.last_seen = None
+        if health:
+            self.srtt = health.get('srtt')
+            self.rttvar = health.get('rttvar')
+            self.failures = health.get('failures', 0)
+            self.last_seen = health.get('last_seen')
+        self.reset()
+
+    def reset(self):
+        # Called before each poll: the circuit breaker is closed again, but a host that did not
+        # answer last time gets one short probe only
+        self.clear()
+        self.dead = False
+        self.initial_timeout = self.configured_timeout
+        self.retries = self.max_retries
+        if self.failures:
+            self.initial_timeout = min(self.configured_timeout, snmp_dead_timeout)
+            self.srtt = None
+            self.retries = 0
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial_timeout
+        return min(snmp_max_timeout, max(snmp_min_timeout, self.srtt + max(0.1, 4 * self.rttvar)))
+
+    def updateRTT(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def getHealth(self):
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'failures': self.failures,
+            'last_seen': self.last_seen
+        }
+
+    def getMetrics(self):
+        address = tuple(self.transport.transportAddr)[:2]
+        return {
+            'collectors': self.metrics.getMetrics(),
+            'bytes_sent': getattr(self.engine.transportDispatcher, 'bytes_sent', {}).get(address, 0),
+            'bytes_received': getattr(self.engine.transportDispatcher, 'bytes_received', {}).get(address, 0)
+        }
+
+    async def measure(self, collector, coroutine):
+        # Requests, varbinds and errors of the coroutine are accounted to the collector
+        with self.metrics.measure(collector):
+            return await coroutine
+
+    async def request(self, command, *args, context = None):
+        # Circuit breaker: once a request went unanswered after all retries, the host is not queried anymore
+        if self.dead:
+            return 'SNMP host marked as not responding', 0, 0, []
+        auth, context_data = context or (self.auth, self.context)
+        timeout = self.timeout()
+        for attempt in range(self.retries + 1):
+            self.metrics.count('requests')
+            # Rounded, because pysnmp keeps a target entry for each timeout value
+            self.transport.timeout = round(min(timeout, snmp_max_timeout), 1)
+            async with self.limit if context is None else self.context_limit:
+                # Each attempt is a packet on the wire; the wait is not part of the round-trip time
+                if self.pps_limit:
+                    await self.pps_limit.acquire()
+                if self.global_limit:
+                    await self.global_limit.acquire()
+                started = time.monotonic()
+                errorIndication, errorStatus, errorIndex, varBinds = await command(
+                    self.engine,
+                    auth,
+                    self.transport,
+                    context_data,
+                    *args,
+                    lookupMib = False
+                )
+                elapsed = time.monotonic() - started
+            if not isinstance(errorIndication, RequestTimedOut):
+                # getCmd returns varbinds, nextCmd and bulkCmd return rows of varbinds. bulkCmd repeats
+                # the non-repeaters at the start of each row, they were received once
+                rows = [row if isinstance(row, list) else [row] for row in varBinds or []]
+                non_repeaters = min(args[0], len(args) - 2) if command is bulkCmd and rows else 0
+                self.metrics.count('varbinds', sum(len(row) - non_repeaters for row in rows) + non_repeaters)
+                if errorIndication or (errorStatus and not (errorStatus == 2 and isinstance(auth, CommunityData) and auth.mpModel == 0)):
+                    # SNMPv1 noSuchName is the normal end of a walk
+                    self.metrics.count('errors')
+                self.updateRTT(elapsed)
+                self.retries = self.max_retries
+                self.failures = 0
+                self.last_seen = int(time.time())
+                return errorIndication, errorStatus, errorIndex, varBinds
+            logger.debug('SNMP host "{}" did not answer within {}s'.format(self.host, self.transport.timeout))
+            self.metrics.count('timeouts')
+            timeout = timeout * 2
+        if context:
+            # A context the agent does not know is not answered, the host is still alive
+            return errorIndication, errorStatus, errorIndex, varBinds
+        self.dead = True
+        self.failures = self.failures + 1
+        return errorIndication, errorStatus, errorIndex, varBinds
+
+    def clear(self):
+        self.collected = {}
+
+    def repetitions(self, columns):
+        # Rows per GETBULK, bounded by the number of varbinds known to fit in a response
+        if self.max_varbinds and columns:
+            return max(1, min(self.max_repetitions, self.max_varbinds // columns))
+        return self.max_repetitions
+
+    def shrinkRepetitions(self, columns, repetitions):
+        # tooBig: halve the varbinds per response (kept for the next requests to this host)
+        if repetitions <= 1 or not columns:
+            return False
+        self.max_varbinds = max(1, columns * repetitions // 2)
+        logger.debug('SNMP host "{}" answered tooBig, lowering varbinds per response to {}'.format(self.host, self.max_varbinds))
+        return True
+
+    async def get(self, *oids):
+        if all(('get', oid) in self.collected for oid in oids):
+            varBinds = []
+            for oid in oids:
+                errorIndication, errorStatus, errorIndex, scalar = self.collected[('get', oid)]
+                if errorIndication or errorStatus or errorIndex:
+                    return errorIndication, errorStatus, errorIndex, []
+                varBinds.extend(scalar)
+            return None, 0, 0, varBinds
+        return await self.request(getCmd, *[ObjectType(ObjectIdentity(oid)) for oid in oids])
+
+    async def walk(self, *oids, context = None):
+        # context: (auth, ContextData) pair to walk another instance of the MIB, see getVLANContext()
+        if not context and ('walk', ) + oids in self.collected:
+            result = self.collected[('walk', ) + oids]
+        elif isinstance(self.auth, CommunityData) and self.auth.mpModel == 0:
+            # GETBULK is not available on SNMPv1
+            result = await self.nextWalk(*oids, context = context)
+        else:
+            result = await self.bulkWalk(*oids, context = context)
+        self.metrics.count('rows', len(result[3]))
+        return result
+
+    async def nextWalk(self, *oids, context = None):
+        # Same as the synchronous nextCmd with lexicographicMode = False: stop when the first column leaves its subtree
+        varBindTable = []
+        prefixes = ['{}.'.format(oid.lstrip('.')) for oid in oids]
+        next_oids = list(oids)
+        while True:
+            errorIndication, errorStatus, errorIndex, varBindRows = await self.request(nextCmd, *[ObjectType(ObjectIdentity(oid)) for oid in next_oids], context = context)
+            if not errorIndication and errorStatus == 2:
+                # SNMPv1 agents answer noSuchName at the end of the MIB
+                return None, 0, 0, varBindTable
+            if errorIndication or errorStatus or errorIndex:
+                return errorIndication, errorStatus, errorIndex, varBindTable
+            varBinds = varBindRows[0]
+            for (oid, value), prefix in zip(varBinds, prefixes):
+                if isinstance(value, EndOfMibView) or not str(oid).startswith(prefix):
+                    return None, 0, 0, varBindTable
+            varBindTable.append(varBinds)
+            next_oids = [str(oid) for oid, value in varBinds]
+
+    async def bulkWalk(self, *oids, context = None):
+        # Same as nextWalk, but each request returns up to max_repetitions rows
+        varBindTable = []
+        prefixes = ['{}.'.format(oid.lstrip('.')) for oid in oids]
+        next_oids = list(oids)
+        while True:
+            repetitions = self.repetitions(len(next_oids))
+            errorIndication, errorStatus, errorIndex, varBindRows = await self.request(bulkCmd, 0, repetitions, *[ObjectType(ObjectIdentity(oid)) for oid in next_oids], context = context)
+            if not errorIndication and errorStatus == 1 and self.shrinkRepetitions(len(next_oids), repetitions):
+                continue
+            if errorIndication or errorStatus or errorIndex:
+                return errorIndication, errorStatus, errorIndex, varBindTable
+            if not varBindRows:
+                return None, 0, 0, varBindTable
+            for varBinds in varBindRows:
+                for (oid, value), prefix in zip(varBinds, prefixes):
+                    if isinstance(value, EndOfMibView) or not str(oid).startswith(prefix):
+                        return None, 0, 0, varBindTable
+                varBindTable.append(varBinds)
+            next_oids = [str(oid) for oid, value in varBindRows[-1]]
+
+    async def collect(self, plan):
+        # Fetches every scalar and table of the plan, packing them in the same requests: scalars are
+        # non-repeaters of the first request, then all unfinished tables are walked side by side.
+        # get() and walk() then answer from the collected varbinds, until clear() is called.
+        bulk = not (isinstance(self.auth, CommunityData) and self.auth.mpModel == 0)
+        scalars = list(plan.scalars)
+        tables = list(plan.tables)
+        varBindTables = {columns: [] for columns in tables}
+        next_oids = {columns: list(columns) for columns in tables}
+        while scalars or tables:
+            request_oids = [oid.rsplit('.', 1)[0] for oid in scalars] + [oid for columns in tables for oid in next_oids[columns]]
+            repetitions = self.repetitions(len(request_oids) - len(scalars))
+            # Rows past the max_rows of a table would be dropped: not asked for while it is walked
+            remaining = [plan.max_rows[columns] - len(varBindTables[columns]) for columns in tables if columns in plan.max_rows]
+            if remaining:
+                repetitions = max(1, min([repetitions] + remaining))
+            if bulk:
+                errorIndication, errorStatus, errorIndex, varBindRows = await self.request(bulkCmd, len(scalars), repetitions, *[ObjectType(ObjectIdentity(oid)) for oid in request_oids])
+            else:
+                errorIndication, errorStatus, errorIndex, varBindRows = await self.request(nextCmd, *[ObjectType(ObjectIdentity(oid)) for oid in request_oids])
+            if bulk and not errorIndication and errorStatus == 1 and self.shrinkRepetitions(len(request_oids) - len(scalars), repetitions):
+                continue
+            if not bulk and not errorIndication and errorStatus == 2 and 0 < errorIndex <= len(request_oids):
+                # SNMPv1 noSuchName: the scalar does not exist or the table reached the end of the MIB
+                position = int(errorIndex) - 1
+                if position < len(scalars):
+                    oid = scalars.pop(position)
+                    self.collected[('get', oid)] = (None, 0, 0, [(ObjectName(oid.lstrip('.')), noSuchObject)])
+                    continue
+                position = position - len(scalars)
+                for columns in tables:
+                    if position < len(columns):
+                        self.collected[('walk', ) + columns] = (None, 0, 0, varBindTables[columns])
+                        tables.remove(columns)
+                        break
+                    position = position - len(columns)
+                continue
+            if errorIndication or errorStatus or errorIndex or not varBindRows:
+                for oid in scalars:
+                    self.collected[('get', oid)] = (errorIndication, errorStatus, errorIndex, [])
+                for columns in tables:
+                    self.collected[('walk', ) + columns] = (errorIndication, errorStatus, errorIndex, varBindTables[columns])
+                return errorIndication, errorStatus, errorIndex
+
+            # Scalars are answered once, in the first row
+            for oid, (rsp_oid, value) in zip(scalars, varBindRows[0]):
+                if str(rsp_oid) == oid.lstrip('.'):
+                    self.collected[('get', oid)] = (None, 0, 0, [(rsp_oid, value)])
+                else:
+                    self.collected[('get', oid)] = (None, 0, 0, [(ObjectName(oid.lstrip('.')), noSuchObject)])
+            offset = len(scalars)
+            scalars = []
+
+            # Each table takes its own columns from every row, until one of them leaves its subtree
+            for columns in list(tables):
+                for varBindRow in varBindRows:
+                    varBinds = varBindRow[offset:offset + len(columns)]
+                    if any(isinstance(value, EndOfMibView) or not str(oid).startswith('{}.'.format(column.lstrip('.'))) for (oid, value), column in zip(varBinds, columns)):
+                        self.collected[('walk', ) + columns] = (None, 0, 0, varBindTables[columns])
+                        tables.remove(columns)
+                        break
+                    varBindTables[columns].append(varBinds)
+                    next_oids[columns] = [str(oid) for oid, value in varBinds]
+                    if len(varBindTables[columns]) == plan.max_rows.get(columns):
+                        self.collected[('walk', ) + columns] = (None, 0, 0, varBindTables[columns])
+                        tables.remove(columns)
+                        break
+                offset = offset + len(columns)
+        return None, 0, 0
+
+def newSNMPEngine():
+    # Timeouts are checked on each dispatcher tick, the default tick (0.5s) is too coarse for adaptive timeouts
+    engine = SnmpEngine()
+    dispatcher = SNMPDispatcher()
+    dispatcher.setTimerResolution(0.1)
+    engine.registerTransportDispatcher(dispatcher)
+    return engine
+
+class SNMPEngines:
+    # pysnmp registers an SNMPv3 user once per engine and by user name only, a second UsmUserData
+    # with the same user name and other keys would be sent with the keys of the first one: hosts
+    # share an engine only if they share the SNMPv3 credentials. SNMPv1/v2c hosts share one engine.
+    # new_engine creates them (SnmpEngine for the synchronous hlapi of the legacy scripts)
+    def __init__(self, new_engine = newSNMPEngine):
+        self.engines = {}
+        self.new_engine = new_engine
+
+    def get(self, auth):
+        key = None
+        if isinstance(auth, UsmUserData):
+            key = (auth.userName, auth.authKey, auth.authProtocol, auth.privKey, auth.privProtocol)
+        if key not in self.engines:
+            self.engines[key] = self.new_engine()
+        return self.engines[key]
+
+    def close(self):
+        for engine in self.engines.values():
+            closeSNMPEngine(engine)
+
+def loadHostHealth(path):
+    try:
+        return json.load(open(path))
+    except FileNotFoundError:
+        return {}
+    except Exception as err:
+        logger.warning('cannot read host health file "{}"'.format(path), exc_info = True)
+        return {}
+
+def saveHostHealth(path, updates):
+    # Merging with the current file, other --shard invocations may have updated it
+    health = loadHostHealth(path)
+    health.update(updates)
+    try:
+        output = open(path, 'w+')
+        output.write(json.dumps(health))
+        output.close()
+    except Exception as err:
+        logger.error('cannot write "{}"'.format(path), exc_info = True)
+
+def closeSNMPEngine(engine):
+    if engine.transportDispatcher:
+        engine.transportDispatcher.closeDispatcher()